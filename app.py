@@ -1,62 +1,201 @@
+import io
+import os
 import re
 import sys
+import queue
+import json
+import logging
+import importlib.util
+import time
 import base64
+import zipfile
+import posixpath
+import cProfile
+import asyncio
+import hashlib
+import signal
 import tempfile
+import threading
 import subprocess
+import tracemalloc
+from html import escape as html_escape, unescape as html_unescape
+from datetime import date
 from pathlib import Path
+import http.client
+import urllib.error
+import urllib.request
+from email.utils import parsedate_to_datetime
+from urllib.parse import unquote
+from functools import lru_cache
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 
 import streamlit as st
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, Comment, NavigableString, Tag
+from bs4.builder import builder_registry
 
 
-# ============================================================
-# Streamlit config
-# ============================================================
-st.set_page_config(page_title="Nirnay MD → HTML/PDF", layout="centered")
+def quiet_bare_mode() -> None:
+    # Cached resources work without a Streamlit session; don't warn about it.
+    logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").setLevel(logging.ERROR)
+
+
+# Imported by the CLIs (no Streamlit server): the cached getters below run
+# at import, so quiet them before the first one.
+if not st.runtime.exists():
+    quiet_bare_mode()
 
 
 # ============================================================
-# 0) Markdown renderer (robust import fallbacks)
+# 0) Markdown renderer (resolved once, reused per thread)
 #    - Works even if `markdown` package is missing.
 #    - Supports tables when possible.
+#    - The backend is picked once per process (NIRNAY_MARKDOWN=auto|fastest|
+#      markdown|markdown2|mistune|plain). "auto" keeps the preference order
+#      below; "fastest" times every installed backend on a sample document.
+#      Backends differ slightly in output, so pin one in production. The
+#      pick is a cached resource: Streamlit reruns reuse it (and its per-thread
+#      converters) instead of re-ranking on every click.
+#    - Converters are not thread-safe: each thread builds its own once and
+#      resets it between documents. Render errors propagate instead of
+#      silently switching libraries.
 # ============================================================
-def render_markdown(md_text: str) -> str:
-    # Try python-markdown
-    try:
-        import markdown as mdlib  # pip: markdown
-        return mdlib.markdown(
-            md_text,
-            extensions=[
-                "tables",
-                "fenced_code",
-                "sane_lists",
-                "smarty",
-                "toc",
-            ],
-        )
-    except Exception:
-        pass
+def _build_python_markdown():
+    import markdown as mdlib  # pip: markdown
+    md = mdlib.Markdown(
+        extensions=[
+            "tables",
+            "fenced_code",
+            "sane_lists",
+            "smarty",
+            "toc",
+        ],
+    )
+    return lambda text: md.reset().convert(text)
 
-    # Try markdown2
-    try:
-        import markdown2  # pip: markdown2
-        return markdown2.markdown(md_text, extras=["tables", "fenced-code-blocks"])
-    except Exception:
-        pass
 
-    # Try mistune
-    try:
-        import mistune  # pip: mistune
-        md = mistune.create_markdown(plugins=["table", "strikethrough", "task_lists"])
-        return md(md_text)
-    except Exception:
-        # Last resort: very minimal (paragraphs only)
+def _build_markdown2():
+    import markdown2  # pip: markdown2
+    md = markdown2.Markdown(extras=["tables", "fenced-code-blocks"])
+    return md.convert  # convert() resets per call
+
+
+def _build_mistune():
+    import mistune  # pip: mistune
+    return mistune.create_markdown(plugins=["table", "strikethrough", "task_lists"])
+
+
+def _build_plain():
+    # Last resort: very minimal (preformatted text)
+    def convert(text: str) -> str:
         escaped = (
-            md_text.replace("&", "&amp;")
+            text.replace("&", "&amp;")
             .replace("<", "&lt;")
             .replace(">", "&gt;")
         )
         return "<pre>" + escaped + "</pre>"
+    return convert
+
+
+MARKDOWN_BACKENDS = {
+    "markdown": _build_python_markdown,
+    "markdown2": _build_markdown2,
+    "mistune": _build_mistune,
+    "plain": _build_plain,
+}
+
+MARKDOWN_SAMPLE = """# Sample {#s}
+
+## 1. Topic title
+
+### Key Analysis
+- point with **bold** and *emphasis* -- "quotes"
+- another point with `code`
+
+| Category | Fact / Detail |
+|---|---|
+| Repo | 6.5% held |
+| CRR | 4% |
+
+### Way Forward
+1. first
+2. second
+"""
+
+
+class MarkdownRenderer:
+    def __init__(self, name: str):
+        self.name = name
+        self._build = MARKDOWN_BACKENDS[name]
+        self._local = threading.local()
+        self.render("")  # fail fast if the library is missing
+
+    def render(self, md_text: str) -> str:
+        convert = getattr(self._local, "convert", None)
+        if convert is None:
+            convert = self._local.convert = self._build()
+        return convert(md_text)
+
+
+def available_markdown_backends() -> list[str]:
+    names = []
+    for name in MARKDOWN_BACKENDS:
+        try:
+            MarkdownRenderer(name)
+        except Exception:
+            continue
+        names.append(name)
+    return names
+
+
+def rank_markdown_backends(samples: list[str] | None = None, repeat: int = 3) -> list[tuple[str, float]]:
+    # (backend, best total seconds over the samples), fastest first; "plain" isn't a real renderer.
+    samples = samples or [MARKDOWN_SAMPLE * 20]
+    ranking = []
+    for name in available_markdown_backends():
+        if name == "plain":
+            continue
+        renderer = MarkdownRenderer(name)
+        best = float("inf")
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            for text in samples:
+                renderer.render(text)
+            best = min(best, time.perf_counter() - t0)
+        ranking.append((name, best))
+    return sorted(ranking, key=lambda item: item[1])
+
+
+def pick_markdown_renderer(name: str | None = None) -> MarkdownRenderer:
+    name = (name or os.environ.get("NIRNAY_MARKDOWN") or "auto").strip()
+    if name == "fastest":
+        ranking = rank_markdown_backends()
+        name = ranking[0][0] if ranking else "plain"
+    if name in MARKDOWN_BACKENDS:
+        try:
+            return MarkdownRenderer(name)
+        except Exception:
+            pass
+    for candidate in MARKDOWN_BACKENDS:
+        try:
+            return MarkdownRenderer(candidate)
+        except Exception:
+            continue
+    return MarkdownRenderer("plain")
+
+
+@st.cache_resource
+def get_markdown_renderer() -> MarkdownRenderer:
+    return pick_markdown_renderer()
+
+
+MARKDOWN_RENDERER = get_markdown_renderer()
+
+
+def render_markdown(md_text: str) -> str:
+    return MARKDOWN_RENDERER.render(md_text)
 
 
 # ============================================================
@@ -320,6 +459,11 @@ body{
   font-size: 0.98em;
 }
 .gridtable .gt-row .gt-cell:last-child{ width: 66%; border-right: none; }
+
+/* Wider tables (3+ columns): equal flexible columns */
+.gridtable.gt-wide .gt-row{ display:flex; }
+.gridtable.gt-wide .gt-cell,
+.gridtable.gt-wide .gt-row .gt-cell:last-child{ width: auto; flex: 1 1 0; min-width: 0; }
 .gridtable .gt-head .gt-cell{
   font-weight: 900;
   background: rgba(15,36,51,.04);
@@ -340,10 +484,49 @@ body{
 
 # ============================================================
 # 2) Playwright setup (Streamlit Cloud)
+#    - An existing install is detected on disk (Playwright's pinned browser
+#      revisions + its INSTALLATION_COMPLETE markers), so the installer
+#      subprocess only runs when something is actually missing.
 # ============================================================
+_INSTALL_LOCK = threading.Lock()
+
+
+def playwright_browsers_path() -> Path:
+    env = os.environ.get("PLAYWRIGHT_BROWSERS_PATH")
+    if env and env != "0":
+        return Path(env)
+    if sys.platform == "win32":
+        return Path(os.environ.get("LOCALAPPDATA", Path.home())) / "ms-playwright"
+    if sys.platform == "darwin":
+        return Path.home() / "Library" / "Caches" / "ms-playwright"
+    return Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "ms-playwright"
+
+
+def chromium_installed() -> bool:
+    try:
+        import playwright  # pip: playwright
+
+        manifest = Path(playwright.__file__).parent / "driver" / "package" / "browsers.json"
+        browsers = json.loads(manifest.read_text(encoding="utf-8"))["browsers"]
+    except (ImportError, OSError, ValueError, KeyError):
+        return False
+
+    root = playwright_browsers_path()
+    needed = [b for b in browsers if b.get("name") in ("chromium", "chromium-headless-shell")]
+    return bool(needed) and all(
+        (root / f"{b['name'].replace('-', '_')}-{b['revision']}" / "INSTALLATION_COMPLETE").exists() for b in needed
+    )
+
+
+def install_chromium() -> None:
+    with _INSTALL_LOCK:
+        if not chromium_installed():
+            subprocess.run([sys.executable, "-m", "playwright", "install", "chromium"], check=True)
+
+
 @st.cache_resource
 def ensure_playwright_chromium():
-    subprocess.run([sys.executable, "-m", "playwright", "install", "chromium"], check=True)
+    install_chromium()
 
 
 # ============================================================
@@ -351,280 +534,845 @@ def ensure_playwright_chromium():
 # ============================================================
 INDEX_TITLES = {"index", "contents", "table of contents", "toc"}
 
+# Cleanup rules, applied in this order:
+#   1. drop empty headings ("##") together with the blank lines around them
+#   2. drop trailing heading attribute blocks:  ## Title {#id}
+#   3. unescape punctuation (helps with odd artifacts)
+#   4. blank line after a table row when the next line is a heading
+# The cleaner streams over the lines once. Rule 2 can reach across lines
+# (blank lines before a "{", a "{...}" spanning lines, blank lines after
+# it), so a heading line borrows just enough following lines to decide and
+# gives back what the match did not consume.
+HEADING_ATTR = re.compile(r"^(#{1,6}\s+.*?)(\s*\{[^{}]*\})\s*$", re.M)
+HEADING_ATTR_START = re.compile(r"#{1,6}\s")
+EMPTY_HEADING_HASHES = {"#" * n for n in range(1, 7)}
+ESCAPED_PUNCT = re.compile(r"\\([\\`*_{}\[\]()#+\-.!|>~])")
+TABLE_ROW = re.compile(r"^\s*\|.*\|\s*$")
+HEADING_LINE = re.compile(r"^\s*#{1,6}\s+\S")
+
+
+def _split_lines(source):
+    # "\n"-separated lines of a string (lazily) or of an iterable of lines.
+    if isinstance(source, str):
+        source = io.StringIO(source, newline="\n")
+    line = ""
+    for line in source:
+        yield line[:-1] if line.endswith("\n") else line
+    if line.endswith("\n"):
+        yield ""  # text ending in a newline has an empty last line
+
+
+def _drop_empty_headings(lines):
+    # A run of blank/empty-heading lines that holds an empty heading goes
+    # away as a whole.
+    blanks: list[str] = []
+    dropping = False
+    kept = False
+    for line in lines:
+        stripped = line.strip()
+        if stripped in EMPTY_HEADING_HASHES:
+            blanks.clear()
+            dropping = True
+        elif not stripped:
+            if not dropping:
+                blanks.append(line)
+        else:
+            yield from blanks
+            blanks.clear()
+            dropping = False
+            kept = True
+            yield line
+    if not dropping:
+        yield from blanks
+    elif kept:
+        yield ""  # the newline ending the last kept line survives
+
+
+def _brace_open(line: str, was_open: bool) -> bool:
+    # Whether the last "{" / "}" read so far is a "{", after reading line.
+    i = max(line.rfind("{"), line.rfind("}"))
+    return was_open if i < 0 else line[i] == "{"
+
+
+def _first_brace(line: str) -> int:
+    return min((j for j in (line.find("{"), line.find("}")) if j >= 0), default=-1)
+
+
+def _strip_heading_attrs(lines):
+    lines = iter(lines)
+    pending: deque[str] = deque()
+    while True:
+        line = pending.popleft() if pending else next(lines, None)
+        if line is None:
+            return
+        if not line.startswith("#") or not HEADING_ATTR_START.match(line):
+            yield line
+            continue
+
+        # Read ahead until HEADING_ATTR can't look past the window: a later
+        # non-blank line, no "{" still open, and no "}" as the last
+        # character. An open "{" only closes across lines without braces,
+        # so a later "{" before any "}" ends the look-ahead as well, unless
+        # nothing but whitespace separates it from the heading text (then it
+        # may start the attribute block itself).
+        window = [line]
+        brace_open = _brace_open(line, False)
+        gap_blank = True
+        can_cap = bool(line.lstrip("#").strip())
+        while True:
+            more = pending.popleft() if pending else next(lines, None)
+            if more is None:
+                break
+            window.append(more)
+            if brace_open and can_cap:
+                i = _first_brace(more)
+                if i >= 0 and more[i] == "{" and not (gap_blank and not more[:i].strip()):
+                    break
+            gap_blank = gap_blank and not more.strip()
+            brace_open = _brace_open(more, brace_open)
+            if more.strip() and not brace_open and not more.rstrip().endswith("}"):
+                break
+
+        chunk = "\n".join(window)
+        m = HEADING_ATTR.match(chunk)
+        if m is None:
+            yield line
+            pending.extendleft(reversed(window[1:]))
+            continue
+        yield m.group(1)
+        rest = chunk[m.end():]
+        if rest:
+            pending.extendleft(reversed(rest[1:].split("\n")))
+
+
+def _unescaped_physical_lines(lines):
+    # Rule 3, then str.splitlines() semantics: \r\n, \r, \v, \x1c, ... also
+    # end lines. None of those is printable, so most lines pass straight on.
+    prev = None
+    for line in lines:
+        if "\\" in line:
+            line = ESCAPED_PUNCT.sub(r"\1", line)
+        if prev is not None:
+            if prev.isprintable():
+                yield prev
+            else:
+                yield from (prev + "\n").splitlines()
+        prev = line
+    if prev is not None:
+        yield from prev.splitlines()
+
+
+def iter_cleanup_markdown(source):
+    # source: markdown text or an iterable of lines; yields cleaned lines.
+    lines = _unescaped_physical_lines(_strip_heading_attrs(_drop_empty_headings(_split_lines(source))))
+
+    prev = next(lines, None)
+    for nxt in lines:
+        yield prev
+        # Ensure blank line after table row if next line is a heading
+        if "|" in prev and TABLE_ROW.match(prev) and nxt.strip() and HEADING_LINE.match(nxt):
+            yield ""
+        prev = nxt
+    if prev is not None:
+        yield prev
+
+
 def cleanup_markdown(md_text: str) -> str:
-    # Remove empty headings
-    md_text = re.sub(r"(?m)^\s*#{1,6}\s*$\n?", "", md_text)
-
-    # Remove trailing heading attribute blocks like:  ## Title {#id}
-    md_text = re.sub(r"(?m)^(#{1,6}\s+.*?)(\s*\{[^{}]*\})\s*$", r"\1", md_text)
-
-    # Unescape punctuation (helps with odd artifacts)
-    md_text = re.sub(r"\\([\\`*_{}\[\]()#+\-.!|>~])", r"\1", md_text)
-
-    # Ensure blank line after table row if next line is a heading
-    lines = md_text.splitlines()
-    out = []
-    for i, line in enumerate(lines):
-        out.append(line)
-        if re.match(r"^\s*\|.*\|\s*$", line):
-            if i + 1 < len(lines):
-                nxt = lines[i + 1]
-                if nxt.strip() and re.match(r"^\s*#{1,6}\s+\S", nxt):
-                    out.append("")
-    return "\n".join(out)
+    return "\n".join(iter_cleanup_markdown(md_text))
+
+WHITESPACE_RUN = re.compile(r"\s+")
+HEADING_CODE_INLINE = re.compile(r"\{[#:.][^{}]*\}")
+HEADING_CODE_TRAILING = re.compile(r"\s*\{[^{}]*\}\s*$")
+HEADING_NUMBERING = re.compile(r"^\(?\s*(\d{1,2}|[ivxlcdm]{1,8})\s*[\.\)\:\-]\s*", re.I)
+
+# Standard section headings: class → keywords, in priority order (the first
+# class with any keyword in the heading wins).
+SECTION_KEYWORDS = (
+    ("syllabus", ("syllabus mapping",)),
+    ("context", ("the context", "why in news")),
+    ("analysis", ("key analysis",)),
+    ("beyond", ("beyond the news", "faculty value addition", "value addition")),
+    ("wayforward", ("way forward",)),
+    ("prelims", ("prelims pointers", "prelims pointer")),
+    ("exercise", ("exercise",)),
+    ("mains", ("mains practice question",)),
+    ("recall", ("recall",)),
+    ("recap", ("recap",)),
+)
+_SECTION_RANK = {kw: (rank, cls) for rank, (cls, kws) in enumerate(SECTION_KEYWORDS) for kw in kws}
+# One scan finds every keyword occurrence, overlapping ones included
+# (zero-width lookahead at each position, alternatives in priority order).
+SECTION_MATCHER = re.compile(
+    "(?=(" + "|".join(re.escape(kw) for _, kws in SECTION_KEYWORDS for kw in kws) + "))"
+)
+
 
 def heading_text(tag) -> str:
-    return re.sub(r"\s+", " ", tag.get_text(" ", strip=True)).strip()
+    return WHITESPACE_RUN.sub(" ", tag.get_text(" ", strip=True)).strip()
 
 def strip_heading_codes(text: str) -> str:
     if not text:
         return ""
-    t = re.sub(r"\s+", " ", text).strip()
+    t = WHITESPACE_RUN.sub(" ", text).strip()
     # Remove inline blocks like {#id} or {something}
-    t = re.sub(r"\{[#:.][^{}]*\}", "", t).strip()
-    t = re.sub(r"\s*\{[^{}]*\}\s*$", "", t).strip()
+    t = HEADING_CODE_INLINE.sub("", t).strip()
+    t = HEADING_CODE_TRAILING.sub("", t).strip()
     return t
 
+@lru_cache(maxsize=4096)
 def normalize_heading(s: str) -> str:
     s = strip_heading_codes(s or "")
-    s = re.sub(r"\s+", " ", s).strip()
+    s = WHITESPACE_RUN.sub(" ", s).strip()
     # remove leading numbering styles: "1. ", "1) ", "(1) ", "I. "
-    s = re.sub(r"^\(?\s*(\d{1,2}|[ivxlcdm]{1,8})\s*[\.\)\:\-]\s*", "", s, flags=re.I)
+    s = HEADING_NUMBERING.sub("", s)
     return s.strip().lower()
 
+@lru_cache(maxsize=4096)
 def classify_section(title: str) -> str | None:
-    t = normalize_heading(title)
-
     # Your standard headers going ahead
-    if "syllabus mapping" in t:
-        return "syllabus"
-    if "the context" in t or "why in news" in t:
-        return "context"
-    if "key analysis" in t:
-        return "analysis"
-    if "beyond the news" in t or "faculty value addition" in t or "value addition" in t:
-        return "beyond"
-    if "way forward" in t:
-        return "wayforward"
-    if "prelims pointers" in t or "prelims pointer" in t:
-        return "prelims"
-    if "exercise" in t:
-        return "exercise"
-    if "mains practice question" in t:
-        return "mains"
-    if "recall" in t:
-        return "recall"
-    if "recap" in t:
-        return "recap"
-
-    return None
+    best = None
+    for m in SECTION_MATCHER.finditer(normalize_heading(title)):
+        hit = _SECTION_RANK[m.group(1)]
+        if best is None or hit < best:
+            best = hit
+            if hit[0] == 0:
+                break
+    return best[1] if best else None
 
 def is_topic_title(h) -> bool:
     # Topic title: H2 that is NOT a standard section heading
-    return h.name == "h2" and heading_text(h) != "" and classify_section(heading_text(h)) is None
+    if h.name != "h2":
+        return False
+    text = heading_text(h)
+    return text != "" and classify_section(text) is None
 
 
 # ============================================================
-# 4) Tables → gridtables (splittable)
+# 4) Soup parsing backend + single-pass transform engine
+#    - PARSER_BACKEND is the BeautifulSoup tree builder: "auto" prefers the
+#      C-accelerated lxml builder when installed, else the stdlib
+#      html.parser. Force one with NIRNAY_PARSER=lxml|html.parser.
+#    - Each transform registers handlers for the tags it cares about;
+#      the whole document is then traversed once, in document order.
+#    - A handler gets (tag, walker) and may return the node that now
+#      occupies the tag's position (e.g. a gridtable or a colorbox);
+#      the walk descends into that node and continues after it.
 # ============================================================
-def tables_to_gridtables(soup: BeautifulSoup) -> None:
-    def append_fragment(tag, fragment_html: str):
-        frag = BeautifulSoup(fragment_html or "", "html.parser")
-        for child in list(frag.contents):
-            tag.append(child)
-
-    for tbl in soup.find_all("table"):
-        headers = []
-        thead = tbl.find("thead")
-        if thead:
-            headers = [th.get_text(" ", strip=True) for th in thead.find_all("th")]
-
-        rows = []
-        tbody = tbl.find("tbody")
-        if tbody:
-            for tr in tbody.find_all("tr"):
-                cells = tr.find_all(["td", "th"])
-                rows.append([c.decode_contents().strip() for c in cells])
-
-        gt = soup.new_tag("div", **{"class": "gridtable"})
-        head = soup.new_tag("div", **{"class": "gt-row gt-head"})
+PARSER_PREFERENCE = ("lxml", "html.parser")
+
+
+def pick_parser(name: str | None = None) -> str:
+    name = (name or os.environ.get("NIRNAY_PARSER") or "auto").strip()
+    if name != "auto":
+        return name if builder_registry.lookup(name) else "html.parser"
+    for candidate in PARSER_PREFERENCE:
+        if builder_registry.lookup(candidate):
+            return candidate
+    return "html.parser"
+
+
+PARSER_BACKEND = pick_parser()
+
+
+def parse_html(html: str, parser: str | None = None) -> BeautifulSoup:
+    parser = parser or PARSER_BACKEND
+    if parser != "html.parser":
+        # Document parsers hoist leading comments and <style>/<meta> out of
+        # the body, and drop leading whitespace; an explicit <body> keeps
+        # the fragment in place, as html.parser does.
+        html = "<body>" + html
+    return BeautifulSoup(html, parser)
+
+
+def fragment_html(soup: BeautifulSoup) -> str:
+    # lxml wraps a fragment in <html><body>; emit only what was parsed.
+    if soup.builder.NAME != "html.parser" and soup.body is not None:
+        return soup.body.decode_contents()
+    return str(soup)
+
+
+def iter_fragment_html(soup: BeautifulSoup):
+    # Same markup as fragment_html(), one top-level node at a time.
+    root = soup.body if soup.builder.NAME != "html.parser" and soup.body is not None else soup
+    for node in root.contents:
+        yield node.decode() if isinstance(node, Tag) else node.output_ready("minimal")
+
+
+HEADING_TAGS = ("h1", "h2", "h3", "h4", "h5", "h6")
+
+
+def tag_classes(tag) -> list[str]:
+    cls = tag.get("class") or []
+    return cls.split() if isinstance(cls, str) else list(cls)
+
+
+class SiblingCursor:
+    # Positions of children in parent.contents. Tag.index() scans from the
+    # front on every call; lookups made in document order scan forward from
+    # the last hit instead, so a walk over n siblings stays O(n).
+    def __init__(self):
+        self._hints: dict[int, tuple] = {}  # id(parent) -> (parent, index)
+
+    def index(self, node) -> int:
+        parent = node.parent
+        contents = parent.contents
+        _, start = self._hints.get(id(parent), (parent, 0))
+        for i in range(min(start, len(contents)), len(contents)):
+            if contents[i] is node:
+                break
+        else:
+            i = parent.index(node)  # something before the hint moved
+        self._hints[id(parent)] = (parent, i)
+        return i
+
+
+def wrap_run(parent: Tag, start: int, stop: int, wrapper: Tag) -> Tag:
+    # Move parent.contents[start:stop] into the empty, detached wrapper,
+    # which takes their place: one slice instead of an extract() (and its
+    # sibling scan) per node. The moved nodes' own element chain is already
+    # contiguous, so only the links at the two ends change.
+    run = parent.contents[start:stop]
+    first, last = run[0], run[-1]
+    before, after = first.previous_sibling, last.next_sibling
+
+    wrapper.previous_element = first.previous_element
+    if wrapper.previous_element is not None:
+        wrapper.previous_element.next_element = wrapper
+    wrapper.next_element = first
+    first.previous_element = wrapper
+
+    wrapper.previous_sibling, wrapper.next_sibling = before, after
+    if before is not None:
+        before.next_sibling = wrapper
+    if after is not None:
+        after.previous_sibling = wrapper
+    first.previous_sibling = last.next_sibling = None
+
+    for node in run:
+        node.parent = wrapper
+    wrapper.contents = run
+    wrapper.parent = parent
+    parent.contents[start:stop] = [wrapper]
+    return wrapper
+
+
+class SoupWalker:
+    def __init__(self, soup: BeautifulSoup, transforms=()):
+        self.soup = soup
+        self.in_box = 0  # number of enclosing .colorbox elements
+        self._handlers: dict[str, list] = {}
+        self._finishers: list = []
+        # id -> tag; holding the tag keeps its id from being reused mid-walk
+        self._visited: dict[int, Tag] = {}
+        self._profile = current_profile()
+        self._registering = ""
+        for transform in transforms:
+            self._registering = getattr(transform, "__name__", "transform").removesuffix("_transform")
+            transform(self)
+
+    def on(self, names, handler) -> None:
+        if self._profile is not None:
+            handler = self._profile.timed(f"transform:{self._registering}", handler)
+        for name in ([names] if isinstance(names, str) else names):
+            self._handlers.setdefault(name, []).append(handler)
+
+    def on_finish(self, fn) -> None:
+        self._finishers.append(fn)
+
+    def run(self) -> None:
+        self._walk(self.soup)
+        for fn in self._finishers:
+            fn(self)
+
+    def _visit(self, tag):
+        self._visited[id(tag)] = tag
+        pos = tag
+        for handler in self._handlers.get(tag.name, ()):
+            replacement = handler(tag, self)
+            if replacement is not None:
+                pos = replacement
+            if tag.parent is None:
+                # Replaced outright (e.g. table -> gridtable); nothing left to handle.
+                break
+        return pos
+
+    def _walk(self, parent) -> None:
+        node = parent.contents[0] if parent.contents else None
+        while node is not None:
+            if isinstance(node, Tag):
+                if id(node) not in self._visited:
+                    node = self._visit(node)
+                boxed = "colorbox" in tag_classes(node)
+                self.in_box += boxed
+                self._walk(node)
+                self.in_box -= boxed
+            node = node.next_sibling
+
+
+def apply_transforms(soup: BeautifulSoup, transforms) -> None:
+    SoupWalker(soup, transforms).run()
+
 
+# ============================================================
+# 5) Tables → gridtables (splittable)
+# ============================================================
+def move_cell_contents(src, dest) -> None:
+    # Move the cell's nodes as-is (no serialize/reparse), trimming the
+    # surrounding whitespace the way str.strip() on its HTML would.
+    for child in list(src.contents):
+        dest.append(child.extract())
+
+    for pick, trim in ((lambda: dest.contents[0], str.lstrip), (lambda: dest.contents[-1], str.rstrip)):
+        while dest.contents and type(pick()) is NavigableString:
+            node = pick()
+            text = trim(str(node))
+            if text:
+                if text != str(node):
+                    node.replace_with(NavigableString(text))
+                break
+            node.extract()
+
+
+def table_to_gridtable(soup: BeautifulSoup, tbl):
+    headers = []
+    thead = tbl.find("thead")
+    if thead:
+        headers = [th.get_text(" ", strip=True) for th in thead.find_all("th")]
+
+    rows = []
+    tbody = tbl.find("tbody")
+    if tbody:
+        for tr in tbody.find_all("tr", recursive=False):
+            rows.append(tr.find_all(["td", "th"], recursive=False))
+
+    # Two-column layout (label | detail) unless the table is genuinely wider
+    ncols = max([len(headers)] + [len(r) for r in rows])
+    wide = ncols > 2
+
+    gt = soup.new_tag("div", **{"class": "gridtable gt-wide" if wide else "gridtable"})
+    head = soup.new_tag("div", **{"class": "gt-row gt-head"})
+
+    if wide:
+        use_headers = headers + [""] * (ncols - len(headers))
+    else:
         use_headers = headers[:2] if headers else ["Category", "Fact / Detail"]
-        for hh in use_headers:
+    for hh in use_headers:
+        cell = soup.new_tag("div", **{"class": "gt-cell"})
+        cell.string = hh
+        head.append(cell)
+    gt.append(head)
+
+    width = ncols if wide else 2
+    for cells in rows:
+        if not cells:
+            continue
+        row = soup.new_tag("div", **{"class": "gt-row"})
+        for i in range(width):
             cell = soup.new_tag("div", **{"class": "gt-cell"})
-            cell.string = hh
-            head.append(cell)
-        gt.append(head)
+            if i < len(cells):
+                move_cell_contents(cells[i], cell)
+            row.append(cell)
+        gt.append(row)
+
+    # The table tag becomes the gridtable in place: replace_with() would
+    # look the table up among all its siblings (a scan per table).
+    tbl.clear()
+    tbl.name = "div"
+    tbl.attrs = gt.attrs
+    for row in list(gt.contents):
+        tbl.append(row.extract())
+    return tbl
 
-        for r in rows:
-            if not r:
-                continue
-            while len(r) < 2:
-                r.append("")
-            row = soup.new_tag("div", **{"class": "gt-row"})
-            c1 = soup.new_tag("div", **{"class": "gt-cell"})
-            append_fragment(c1, r[0])
-            c2 = soup.new_tag("div", **{"class": "gt-cell"})
-            append_fragment(c2, r[1])
-            row.append(c1)
-            row.append(c2)
-            gt.append(row)
 
-        tbl.replace_with(gt)
+def gridtable_transform(walker: SoupWalker) -> None:
+    walker.on("table", lambda tbl, w: table_to_gridtable(w.soup, tbl))
+
+
+def tables_to_gridtables(soup: BeautifulSoup) -> None:
+    apply_transforms(soup, [gridtable_transform])
 
 
 # ============================================================
-# 5) Images: wrap + prevent any forced sizing
+# 6) Images: wrap + prevent any forced sizing
 # ============================================================
-def normalize_images(soup: BeautifulSoup) -> None:
-    for img in soup.find_all("img"):
-        # Remove any converter-injected sizing
-        for attr in ("width", "height", "style"):
-            if img.has_attr(attr):
-                del img[attr]
+def normalize_image(soup: BeautifulSoup, img):
+    # Remove any converter-injected sizing
+    for attr in ("width", "height", "style"):
+        if img.has_attr(attr):
+            del img[attr]
+
+    # Wrap in figure (for padding/background + center alignment)
+    if not (img.parent and img.parent.name == "figure"):
+        fig = soup.new_tag("figure", **{"class": "md-figure"})
+        img.wrap(fig)
+        return fig
+    return None
+
 
-        # Wrap in figure (for padding/background + center alignment)
-        if not (img.parent and img.parent.name == "figure"):
-            fig = soup.new_tag("figure", **{"class": "md-figure"})
-            img.wrap(fig)
+def image_transform(walker: SoupWalker) -> None:
+    walker.on("img", lambda img, w: normalize_image(w.soup, img))
+
+
+def normalize_images(soup: BeautifulSoup) -> None:
+    apply_transforms(soup, [image_transform])
 
 
 # ============================================================
-# 6) Page break after Index/Contents section
+# 7) Page break after Index/Contents section
 # ============================================================
+def index_pagebreak_transform(walker: SoupWalker) -> None:
+    # Insert before the first heading (any level) after an Index / Contents / TOC heading
+    state = {"index": None, "done": False}
+
+    def on_heading(h, w):
+        if state["done"]:
+            return None
+        if state["index"] is None:
+            if normalize_heading(heading_text(h)) in INDEX_TITLES:
+                state["index"] = h
+            return None
+        h.insert_before(w.soup.new_tag("div", **{"class": "page-break"}))
+        state["done"] = True
+        return None
+
+    def finish(w):
+        if state["index"] is not None and not state["done"]:
+            state["index"].insert_after(w.soup.new_tag("div", **{"class": "page-break"}))
+
+    walker.on(HEADING_TAGS, on_heading)
+    walker.on_finish(finish)
+
+
 def insert_pagebreak_after_index(soup: BeautifulSoup) -> None:
-    # Find a heading matching Index / Contents / TOC
-    for h in soup.find_all(["h1", "h2", "h3", "h4", "h5", "h6"]):
-        t = normalize_heading(heading_text(h))
-        if t in INDEX_TITLES:
-            pb = soup.new_tag("div", **{"class": "page-break"})
-            # Insert before the next heading (any level)
-            nxt = h.find_next(lambda tag: getattr(tag, "name", None) in ["h1","h2","h3","h4","h5","h6"] and tag is not h)
-            if nxt:
-                nxt.insert_before(pb)
-            else:
-                h.insert_after(pb)
-            break
+    apply_transforms(soup, [index_pagebreak_transform])
 
 
-# ============================================================
-# 7) Wrap sections in color boxes + tag topics + clean heading text
-# ============================================================
-def wrap_sections_and_tag_topics(soup: BeautifulSoup) -> None:
-    # Clean heading displayed text (remove {#...} etc)
-    for h in soup.find_all(["h1","h2","h3","h4","h5","h6"]):
-        cleaned = strip_heading_codes(heading_text(h))
-        h.clear()
-        h.append(cleaned)
+# Per-topic fragments (see incremental rendering) can't see their neighbours,
+# so they carry comment markers for every place the page break might go and
+# the document assembler decides which one becomes the real break.
+PB_MARK_NEXT = "nirnay:pb-next"    # before the first heading after the Index
+PB_MARK_AFTER = "nirnay:pb-after"  # right after the Index (no later heading in fragment)
+PB_MARK_FIRST = "nirnay:pb-first"  # before the fragment's first heading
 
-    # Tag topic titles
-    for h2 in soup.find_all("h2"):
-        if is_topic_title(h2):
-            h2["class"] = (h2.get("class", []) + ["topic-title"])
 
-    headings = soup.find_all(["h1","h2","h3","h4","h5","h6"])
+def index_marker_transform(walker: SoupWalker) -> None:
+    state = {"first": False, "index": None, "done": False}
+
+    def on_heading(h, w):
+        if not state["first"]:
+            h.insert_before(Comment(PB_MARK_FIRST))
+            state["first"] = True
+        if state["done"]:
+            return None
+        if state["index"] is None:
+            if normalize_heading(heading_text(h)) in INDEX_TITLES:
+                state["index"] = h
+            return None
+        h.insert_before(Comment(PB_MARK_NEXT))
+        state["done"] = True
+        return None
+
+    def finish(w):
+        if state["index"] is not None and not state["done"]:
+            state["index"].insert_after(Comment(PB_MARK_AFTER))
+
+    walker.on(HEADING_TAGS, on_heading)
+    walker.on_finish(finish)
 
-    def is_heading(node) -> bool:
-        return getattr(node, "name", None) in ("h1","h2","h3","h4","h5","h6")
 
-    def already_in_box(h):
-        return h.find_parent(class_="colorbox") is not None
+# ============================================================
+# 8) Wrap sections in color boxes + tag topics + clean heading text
+# ============================================================
+def section_transform(walker: SoupWalker) -> None:
+    # Cleaned heading text, computed once from the raw heading. Sections are
+    # wrapped before later headings are visited, so the stop test below must
+    # see the cleaned text of headings the walk hasn't reached yet.
+    # Each heading is cleaned and classified once: id → (tag, text, class).
+    cleaned: dict[int, tuple] = {}
+    cursor = SiblingCursor()
+
+    def heading_info(h) -> tuple:
+        hit = cleaned.get(id(h))
+        if hit is None:
+            text = strip_heading_codes(heading_text(h))
+            hit = cleaned[id(h)] = (h, text, classify_section(text))
+        return hit
+
+    def is_heading(node) -> bool:
+        return getattr(node, "name", None) in HEADING_TAGS
 
     def is_topic_heading(h):
-        return is_heading(h) and h.name == "h2" and classify_section(heading_text(h)) is None and heading_text(h) != ""
+        if not is_heading(h) or h.name != "h2":
+            return False
+        _, text, cls = heading_info(h)
+        return cls is None and text != ""
 
     def is_section_heading(h):
-        return is_heading(h) and classify_section(heading_text(h)) is not None
+        return is_heading(h) and heading_info(h)[2] is not None
 
     def wrap_from(start_h, class_name: str):
-        if already_in_box(start_h):
-            return
-        box = soup.new_tag("div", **{"class": f"colorbox {class_name}"})
-        start_h.insert_before(box)
+        box = walker.soup.new_tag("div", **{"class": f"colorbox {class_name}"})
+        start = cursor.index(start_h)
 
-        cur = start_h
+        stop = start + 1
+        cur = start_h.next_sibling
         while cur is not None:
-            nxt = cur.next_sibling
+            # Stop at HR
+            if getattr(cur, "name", None) == "hr":
+                break
+            # Stop when next major block begins
+            if is_heading(cur) and (is_topic_heading(cur) or is_section_heading(cur)):
+                break
+            stop += 1
+            cur = cur.next_sibling
+        return wrap_run(start_h.parent, start, stop, box)
+
+    def on_heading(h, w):
+        # Clean heading displayed text (remove {#...} etc)
+        _, text, cls = heading_info(h)
+        h.clear()
+        h.append(text)
 
-            if cur is not start_h:
-                # Stop at HR
-                if getattr(cur, "name", None) == "hr":
-                    break
-                # Stop when next major block begins
-                if is_heading(cur) and (is_topic_heading(cur) or is_section_heading(cur)):
-                    break
+        # Tag topic titles
+        if is_topic_heading(h):
+            h["class"] = (h.get("class", []) + ["topic-title"])
 
-            box.append(cur.extract())
-            cur = nxt
+        if w.in_box:
+            return None
+        return wrap_from(h, cls) if cls else None
 
-    for h in headings:
-        if not is_heading(h) or already_in_box(h):
-            continue
-        cls = classify_section(heading_text(h))
-        if cls:
-            wrap_from(h, cls)
+    walker.on(HEADING_TAGS, on_heading)
+
+
+def wrap_sections_and_tag_topics(soup: BeautifulSoup) -> None:
+    apply_transforms(soup, [section_transform])
 
 
 # ============================================================
-# 8) Optional: inline local images as data URIs (no MD changes)
+# 9) Optional: inline local images as data URIs (no MD changes)
 #    - Helps when users upload MD + images in same folder.
 #    - If image paths aren't accessible, it leaves them unchanged.
+#    - Each file is read, hashed and encoded once per document; repeats
+#      (same path or same bytes) reuse the data URI.
+#    - With Pillow installed, images wider than the A4 content width at
+#      IMAGE_PRINT_DPI are downscaled (they print at max-width: 100%
+#      anyway), and NIRNAY_IMAGE_FORMAT=webp|jpeg re-encodes them when that
+#      is smaller. Processed variants are kept in the render cache, keyed by
+#      source hash + settings.
 # ============================================================
-def inline_local_images(soup: BeautifulSoup, base_dir: Path | None) -> None:
-    if base_dir is None:
-        return
-
-    for img in soup.find_all("img"):
-        src = img.get("src") or ""
-        if not src or src.startswith(("http://", "https://", "data:")):
-            continue
+IMAGE_MIME = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".webp": "image/webp",
+    ".gif": "image/gif",
+    ".svg": "image/svg+xml",
+}
+IMAGE_PRINT_DPI = 200
+IMAGE_CONTENT_WIDTH_MM = 186  # A4 minus @page margins and figure padding
+IMAGE_MAX_PX = round(IMAGE_CONTENT_WIDTH_MM / 25.4 * IMAGE_PRINT_DPI)
+IMAGE_REENCODE = (os.environ.get("NIRNAY_IMAGE_FORMAT") or "").lower() or None
+IMAGE_QUALITY = 85
 
-        # Resolve local paths
-        src_path = (base_dir / src).resolve()
-        if not src_path.exists() or not src_path.is_file():
-            continue
 
-        ext = src_path.suffix.lower()
-        mime = {
-            ".png": "image/png",
-            ".jpg": "image/jpeg",
-            ".jpeg": "image/jpeg",
-            ".webp": "image/webp",
-            ".gif": "image/gif",
-            ".svg": "image/svg+xml",
-        }.get(ext, None)
-        if mime is None:
-            continue
+def optimize_image(data: bytes, mime: str) -> tuple[bytes, str]:
+    # (bytes, mime) ready to inline; the input unchanged if nothing helps.
+    if mime in ("image/svg+xml", "image/gif"):
+        return data, mime
+    try:
+        from PIL import Image, ImageOps  # pip: pillow (optional)
+    except ImportError:
+        return data, mime
 
-        try:
-            data = src_path.read_bytes()
-            b64 = base64.b64encode(data).decode("utf-8")
-            img["src"] = f"data:{mime};base64,{b64}"
-        except Exception:
-            pass
+    try:
+        with Image.open(io.BytesIO(data)) as im:
+            width, height = im.size
+            if width <= IMAGE_MAX_PX and not IMAGE_REENCODE:
+                return data, mime
+
+            out_img = ImageOps.exif_transpose(im)  # EXIF is dropped on re-encode
+            if out_img.width > IMAGE_MAX_PX:
+                new_h = max(1, round(out_img.height * IMAGE_MAX_PX / out_img.width))
+                out_img = out_img.resize((IMAGE_MAX_PX, new_h), Image.LANCZOS)
+
+            has_alpha = out_img.mode in ("RGBA", "LA") or (out_img.mode == "P" and "transparency" in out_img.info)
+            fmt = IMAGE_REENCODE or {"image/png": "png", "image/jpeg": "jpeg", "image/webp": "webp"}[mime]
+            if fmt == "jpeg" and has_alpha:
+                fmt = "png"
+            if fmt == "jpeg" and out_img.mode != "RGB":
+                out_img = out_img.convert("RGB")
+
+            buf = io.BytesIO()
+            if fmt == "png":
+                out_img.save(buf, format="PNG", optimize=True)
+            else:
+                out_img.save(buf, format=fmt.upper(), quality=IMAGE_QUALITY)
+            new = buf.getvalue()
+    except Exception:
+        return data, mime
+
+    if len(new) >= len(data) and width <= IMAGE_MAX_PX:
+        return data, mime  # re-encoding alone didn't pay off
+    return new, f"image/{fmt}"
+
+
+def cached_optimize_image(data: bytes, mime: str) -> tuple[bytes, str]:
+    cache = get_render_cache()
+    key = image_cache_key(data, mime)
+    hit = cache.get(key)
+    if hit is not None:
+        out_mime, _, out = hit.partition(b"\0")
+        return out, out_mime.decode("ascii")
+    out, out_mime = optimize_image(data, mime)
+    cache.put(key, out_mime.encode("ascii") + b"\0" + out)
+    return out, out_mime
+
+
+# Image references in markdown: ![alt](src), raw <img src>, [id]: src
+MD_IMAGE_REF = re.compile(
+    r"!\[[^\]]*\]\(\s*<?([^)\s>]+)"
+    r"""|<img\b[^>]*?\bsrc\s*=\s*["']([^"']+)"""
+    r"|^ {0,3}\[[^\]]+\]:\s*<?([^\s>]+)",
+    re.IGNORECASE | re.MULTILINE,
+)
+
+
+def markdown_image_refs(md_text: str) -> set[str]:
+    refs = {a or b or c for a, b, c in MD_IMAGE_REF.findall(md_text)}
+    return {r for r in refs if not r.startswith(("http://", "https://", "data:"))}
+
+
+class DirAssets:
+    # Images next to a markdown file on disk.
+    def __init__(self, base_dir: Path):
+        self.base_dir = base_dir
+        self.fingerprint = str(base_dir)
+
+    def locate(self, src: str) -> str | None:
+        path = (self.base_dir / src).resolve()
+        return str(path) if path.is_file() else None
+
+    def read(self, ref: str) -> bytes:
+        return Path(ref).read_bytes()
+
+    def content_fingerprint(self, md_text: str) -> str:
+        # The folder plus size and mtime of each image md_text refers to, so
+        # an edited image changes every key built on it.
+        h = hashlib.sha256()
+        for src in sorted(markdown_image_refs(md_text)):
+            ref = self.locate(src)
+            if ref is None:
+                continue
+            try:
+                st_ = os.stat(ref)
+            except OSError:
+                continue
+            h.update(f"{ref}|{st_.st_size}|{st_.st_mtime_ns}\n".encode("utf-8"))
+        return f"{self.fingerprint}:{h.hexdigest()[:16]}"
+
+
+class ZipAssets:
+    # Images inside an uploaded .zip bundle, read member by member straight
+    # from the archive (never extracted, never copied as a whole).
+    def __init__(self, zf: zipfile.ZipFile, md_dir: str = ""):
+        self.zf = zf
+        self.md_dir = md_dir
+        self._names = {info.filename for info in zf.infolist() if not info.is_dir()}
+        # Central-directory CRCs identify the content without reading it.
+        h = hashlib.sha256()
+        for info in sorted(zf.infolist(), key=lambda i: i.filename):
+            h.update(f"{info.filename}|{info.CRC}|{info.file_size}\n".encode("utf-8"))
+        self.fingerprint = f"zip:{h.hexdigest()}:{md_dir}"
+
+    def locate(self, src: str) -> str | None:
+        name = posixpath.normpath(posixpath.join(self.md_dir, unquote(src).replace("\\", "/")))
+        return name if name in self._names else None
+
+    def read(self, ref: str) -> bytes:
+        with self.zf.open(ref) as member:
+            return member.read()
+
+    def content_fingerprint(self, md_text: str) -> str:
+        return self.fingerprint  # already covers every member's content
+
+
+def open_bundle(fileobj) -> tuple[str, str, ZipAssets]:
+    # (markdown member name, markdown text, assets) for a .zip of MD + images.
+    # Picks the shallowest .md in the archive (ignoring macOS metadata).
+    zf = zipfile.ZipFile(fileobj)
+    candidates = [
+        n for n in zf.namelist()
+        if n.lower().endswith((".md", ".markdown")) and not n.startswith("__MACOSX/")
+    ]
+    if not candidates:
+        raise ValueError("The .zip does not contain a .md file.")
+    md_name = min(candidates, key=lambda n: (n.count("/"), n))
+    with zf.open(md_name) as member:
+        md_text = member.read().decode("utf-8", errors="ignore")
+    return md_name, md_text, ZipAssets(zf, posixpath.dirname(md_name))
+
+
+def as_assets(assets) -> "DirAssets | ZipAssets | None":
+    return DirAssets(assets) if isinstance(assets, Path) else assets
+
+
+def image_data_uri(assets, src: str, memo: dict) -> str | None:
+    # memo: per-document {asset ref: uri, sha256: uri}
+    ref = assets.locate(src)
+    if ref is None:
+        return None
+    uri = memo.get(ref)
+    if uri is not None:
+        return uri
+
+    mime = IMAGE_MIME.get(posixpath.splitext(ref)[1].lower())
+    if mime is None:
+        return None
+    try:
+        data = assets.read(ref)
+    except (OSError, KeyError, zipfile.BadZipFile):
+        return None
+
+    digest = hashlib.sha256(data).hexdigest()
+    uri = memo.get(digest)
+    if uri is None:
+        data, mime = cached_optimize_image(data, mime)
+        b64 = base64.b64encode(data).decode("utf-8")
+        uri = memo[digest] = f"data:{mime};base64,{b64}"
+    memo[ref] = uri
+    return uri
+
+
+def inline_local_image(img, assets, memo: dict | None = None) -> None:
+    src = img.get("src") or ""
+    if not src or src.startswith(("http://", "https://", "data:")):
+        return
 
+    uri = image_data_uri(as_assets(assets), src, {} if memo is None else memo)
+    if uri is not None:
+        img["src"] = uri
 
-# ============================================================
-# 9) Markdown → full HTML
-# ============================================================
-def md_to_full_html(md_text: str, title_fallback: str, md_filename: str | None = None) -> str:
-    md_text = cleanup_markdown(md_text)
 
-    body_html = render_markdown(md_text)
-    soup = BeautifulSoup(body_html, "html.parser")
+def inline_images_transform(assets, memo: dict | None = None):
+    # assets: a base folder (Path), DirAssets / ZipAssets, or None
+    # memo: shared by every piece of one document (see image_data_uri)
+    assets = as_assets(assets)
 
-    # Convert tables
-    tables_to_gridtables(soup)
+    def inline_images(walker: SoupWalker) -> None:
+        if assets is not None:
+            doc_memo = {} if memo is None else memo
+            walker.on("img", lambda img, w: inline_local_image(img, assets, doc_memo))
+    return inline_images
 
-    # Wrap sections + topics + clean headings
-    wrap_sections_and_tag_topics(soup)
 
-    # Normalize image tags (wrap + remove sizing)
-    normalize_images(soup)
+def inline_local_images(soup: BeautifulSoup, base_dir: Path | None) -> None:
+    apply_transforms(soup, [inline_images_transform(base_dir)])
 
-    # Page break after Index
-    insert_pagebreak_after_index(soup)
 
+# ============================================================
+# 10) Markdown → full HTML
+# ============================================================
+def resolve_base_dir(md_filename: str | None) -> Path | None:
     # Attempt to inline local images if possible (only works if the files exist server-side)
     # In Streamlit Cloud, uploaded MD doesn't include companion images unless you also upload them.
     base_dir = None
@@ -636,25 +1384,27 @@ def md_to_full_html(md_text: str, title_fallback: str, md_filename: str | None =
                 base_dir = p.parent
         except Exception:
             base_dir = None
-    inline_local_images(soup, base_dir)
+    return base_dir
 
-    # Document title
-    h1 = soup.find("h1")
-    doc_title = (h1.get_text(" ", strip=True).upper() if h1 else title_fallback.upper())
 
-    return f"""<!doctype html>
+# The page around the body, in pieces, so documents can be streamed to a
+# sink (file, HTTP response) without building the whole string first.
+DOC_PROLOGUE = """<!doctype html>
 <html>
 <head>
   <meta charset="utf-8"/>
   <meta name="viewport" content="width=device-width,initial-scale=1"/>
-  <title>{doc_title}</title>
-  <style>{STANDARD_CSS}</style>
+  <title>"""
+DOC_STYLE_OPEN = """</title>
+  <style>"""
+DOC_BODY_OPEN = """</style>
 </head>
 <body>
   <div class="page">
     <article class="book">
       <div class="prose">
-        {str(soup)}
+        """
+DOC_EPILOGUE = """
       </div>
     </article>
   </div>
@@ -663,72 +1413,2105 @@ def md_to_full_html(md_text: str, title_fallback: str, md_filename: str | None =
 """
 
 
+def iter_document(doc_title: str, body_chunks):
+    yield DOC_PROLOGUE
+    yield doc_title
+    yield DOC_STYLE_OPEN
+    yield STANDARD_CSS
+    yield DOC_BODY_OPEN
+    yield from body_chunks
+    yield DOC_EPILOGUE
+
+
+def full_document(doc_title: str, body: str) -> str:
+    return "".join(iter_document(doc_title, (body,)))
+
+
+def write_chunks(chunks, sink, encoding: str | None = None) -> int:
+    # sink: anything with .write(); pass encoding for binary sinks.
+    written = 0
+    for chunk in chunks:
+        data = chunk.encode(encoding) if encoding else chunk
+        sink.write(data)
+        written += len(data)
+    return written
+
+
+def resolve_assets(md_filename: str | None, assets=None):
+    if assets is not None:
+        return as_assets(assets)
+    base_dir = resolve_base_dir(md_filename)
+    return DirAssets(base_dir) if base_dir is not None else None
+
+
+def document_transforms(assets) -> list:
+    # One walk over the tree; handlers run in this order for each tag
+    return [
+        gridtable_transform,               # convert tables
+        section_transform,                 # wrap sections + topics + clean headings
+        image_transform,                   # normalize image tags (wrap + remove sizing)
+        index_pagebreak_transform,         # page break after Index
+        inline_images_transform(assets),
+    ]
+
+
+def render_document(
+    md_text: str, title_fallback: str, md_filename: str | None = None, assets=None
+) -> tuple[str, BeautifulSoup]:
+    # (document title, transformed body tree)
+    with stage("cleanup_markdown"):
+        md_text = cleanup_markdown(md_text)
+
+    with stage("render_markdown"):
+        body_html = render_markdown(md_text)
+
+    with stage("parse"):
+        soup = parse_html(body_html)
+
+    assets = resolve_assets(md_filename, assets)
+
+    with stage("transforms"):
+        apply_transforms(soup, document_transforms(assets))
+
+    # Document title
+    h1 = soup.find("h1")
+    doc_title = (h1.get_text(" ", strip=True).upper() if h1 else title_fallback.upper())
+    return doc_title, soup
+
+
+def iter_full_html(md_text: str, title_fallback: str, md_filename: str | None = None, assets=None):
+    # The document as a stream of str chunks; peak memory is the tree plus
+    # one top-level block, not the whole serialized page.
+    doc_title, soup = render_document(md_text, title_fallback, md_filename, assets)
+    yield from iter_document(doc_title, iter_fragment_html(soup))
+
+
+def md_to_full_html(md_text: str, title_fallback: str, md_filename: str | None = None, assets=None) -> str:
+    doc_title, soup = render_document(md_text, title_fallback, md_filename, assets)
+    with stage("serialize"):
+        return "".join(iter_document(doc_title, iter_fragment_html(soup)))
+
+
 # ============================================================
-# 10) HTML → PDF bytes (Playwright)
+# 11) HTML → PDF bytes (Playwright, warm browser pool)
+#    - Chromium is launched once per process, not once per click.
+#    - Playwright's sync API is bound to the thread that started it, so each
+#      pooled browser lives on its own worker thread and jobs are handed over
+#      through a queue.
+#    - Browsers are recycled after PDF_POOL_MAX_JOBS prints, when their own
+#      Chromium processes cross PDF_POOL_MAX_RSS_MB (needs psutil), or when
+#      they die.
+#    - page.pdf() has no timeout of its own. A job its caller gave up on is
+#      abandon()ed: its worker's Playwright driver (and, with psutil, the
+#      Chromium under it) is killed, so the call fails and the worker starts
+#      a fresh driver and browser instead of staying stuck.
 # ============================================================
-def html_to_pdf_bytes(full_html: str) -> bytes:
-    from playwright.sync_api import sync_playwright
+PDF_POOL_SIZE = 2
+PDF_POOL_MAX_JOBS = 50
+PDF_POOL_MAX_RSS_MB = 1500
+
+
+def chromium_rss_mb(driver_pid: int | None) -> float | None:
+    # Combined RSS of the Chromium processes under one worker's Playwright
+    # driver; other pooled browsers and unrelated children don't count.
+    if driver_pid is None:
+        return None
+    try:
+        import psutil  # pip: psutil (optional)
+    except ImportError:
+        return None
+
+    try:
+        children = psutil.Process(driver_pid).children(recursive=True)
+    except psutil.Error:
+        return None
+    total = 0
+    for child in children:
+        try:
+            total += child.memory_info().rss
+        except psutil.Error:
+            pass
+    return total / (1024 * 1024)
+
+
+def playwright_driver_pid(p) -> int | None:
+    # Playwright has no public handle on its driver process; this is the
+    # subprocess behind the sync API's pipe transport.
+    try:
+        return p._impl_obj._connection._transport._proc.pid
+    except AttributeError:
+        return None
+
+
+def kill_process_tree(pid: int) -> None:
+    try:
+        import psutil  # pip: psutil (optional)
+    except ImportError:
+        psutil = None
+
+    if psutil is not None:
+        try:
+            proc = psutil.Process(pid)
+            procs = proc.children(recursive=True) + [proc]
+        except psutil.Error:
+            return
+        for proc in procs:
+            try:
+                proc.kill()
+            except psutil.Error:
+                pass
+        return
+    # Without psutil only the driver goes; Chromium exits when its pipe closes.
+    try:
+        os.kill(pid, getattr(signal, "SIGKILL", signal.SIGTERM))
+    except OSError:
+        pass
 
-    with tempfile.TemporaryDirectory() as td:
-        td = Path(td)
-        html_path = td / "doc.html"
-        html_path.write_text(full_html, encoding="utf-8")
 
-        with sync_playwright() as p:
+class BrowserPool:
+    def __init__(
+        self,
+        size: int = PDF_POOL_SIZE,
+        max_jobs: int = PDF_POOL_MAX_JOBS,
+        max_rss_mb: float | None = PDF_POOL_MAX_RSS_MB,
+        warm: bool = True,
+    ):
+        self.size = max(1, size)
+        self.max_jobs = max_jobs
+        self.max_rss_mb = max_rss_mb
+        if max_rss_mb is not None and importlib.util.find_spec("psutil") is None:
+            logging.getLogger("nirnay").warning(
+                "psutil is not installed: browsers will not be recycled at %s MB RSS", max_rss_mb
+            )
+        self.launches = 0
+        self.jobs_done = 0
+        self.abandoned = 0
+        self._jobs: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._leases: dict[Future, dict] = {}  # running job -> {"pid", "killed"}
+        self._workers = [
+            threading.Thread(target=self._worker, args=(warm,), name=f"pdf-browser-{i}", daemon=True)
+            for i in range(self.size)
+        ]
+        for w in self._workers:
+            w.start()
+
+    def submit(self, fn, *args) -> Future:
+        # fn(browser, *args) runs on a pool thread with a healthy, warm browser.
+        # The job runs in a copy of the caller's context (profiling etc.).
+        fut: Future = Future()
+        self._jobs.put((fut, copy_context(), fn, args))
+        return fut
+
+    def run(self, fn, *args, timeout: float | None = None):
+        fut = self.submit(fn, *args)
+        try:
+            return fut.result(timeout=timeout)
+        except TimeoutError:
+            self.abandon(fut)
+            raise
+
+    def abandon(self, fut: Future) -> None:
+        # Drop a job nobody waits for any more. Queued: it never runs.
+        # Running: its driver is killed, which fails the call and frees the slot.
+        if fut.cancel():
+            return
+        with self._lock:
+            lease = self._leases.get(fut)
+            if lease is None or lease["killed"]:
+                return
+            lease["killed"] = True
+            pid = lease["pid"]
+            self.abandoned += 1
+        if pid is not None:
+            kill_process_tree(pid)
+
+    def shutdown(self) -> None:
+        for _ in self._workers:
+            self._jobs.put(None)
+        for w in self._workers:
+            w.join(timeout=30)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": self.size,
+                "launches": self.launches,
+                "jobs_done": self.jobs_done,
+                "abandoned": self.abandoned,
+                "queued": self._jobs.qsize(),
+            }
+
+    def _launch(self, p):
+        with stage("pdf:launch"):
             browser = p.chromium.launch()
-            # Higher scale helps text crispness; images remain their true pixels (no forced upscaling)
-            context = browser.new_context(device_scale_factor=2)
-            page = context.new_page()
-            page.goto(html_path.as_uri(), wait_until="networkidle")
-            page.emulate_media(media="print")
-
-            # Let @page margins apply
-            pdf_bytes = page.pdf(
+        with self._lock:
+            self.launches += 1
+        return browser
+
+    @staticmethod
+    def _close(browser) -> None:
+        if browser is None:
+            return
+        try:
+            browser.close()
+        except Exception:
+            pass
+
+    def _over_memory(self, driver_pid: int | None) -> bool:
+        if self.max_rss_mb is None:
+            return False
+        rss = chromium_rss_mb(driver_pid)
+        return rss is not None and rss > self.max_rss_mb
+
+    def _worker(self, warm: bool) -> None:
+        from playwright.sync_api import sync_playwright
+
+        p = None
+        browser = None
+        jobs = 0
+
+        def healthy_browser():
+            nonlocal p, browser, jobs
+            if p is None:
+                p = sync_playwright().start()
+            if browser is None or not browser.is_connected():
+                self._close(browser)
+                browser = self._launch(p)
+                jobs = 0
+            return browser
+
+        if warm:
+            try:
+                healthy_browser()
+            except Exception:
+                # Chromium may not be installed yet; retry on the first job.
+                pass
+
+        while True:
+            item = self._jobs.get()
+            if item is None:
+                break
+            fut, ctx, fn, args = item
+            if not fut.set_running_or_notify_cancel():
+                continue
+            lease = {"pid": None, "killed": False}
+            with self._lock:
+                self._leases[fut] = lease
+
+            def leased_browser():
+                b = healthy_browser()
+                with self._lock:
+                    lease["pid"] = playwright_driver_pid(p)
+                    if lease["killed"]:
+                        raise TimeoutError("abandoned while the browser was starting")
+                return b
+
+            try:
+                fut.set_result(ctx.run(lambda: fn(leased_browser(), *args)))
+            except BaseException as e:
+                fut.set_exception(e)
+                # The browser may be wedged; start fresh on the next job.
+                self._close(browser)
+                browser = None
+                if lease["killed"]:
+                    # The driver was killed too; Playwright restarts with it.
+                    try:
+                        p.stop()
+                    except Exception:
+                        pass
+                    p = None
+                continue
+            finally:
+                with self._lock:
+                    self._leases.pop(fut, None)
+
+            jobs += 1
+            with self._lock:
+                self.jobs_done += 1
+            if jobs >= self.max_jobs or self._over_memory(playwright_driver_pid(p)):
+                self._close(browser)
+                browser = None
+
+        self._close(browser)
+        if p is not None:
+            try:
+                p.stop()
+            except Exception:
+                pass
+
+
+@st.cache_resource
+def get_browser_pool() -> BrowserPool:
+    return BrowserPool()
+
+
+# ------------------------------------------------------------
+# Start-up warm-up
+#    - When the app is served, Chromium is provisioned and one trivial page
+#      is printed in the background, so the first "Generate PDF" after a
+#      deploy finds a launched browser with fonts and the PDF path loaded.
+#    - NIRNAY_PDF_PREWARM=0 turns it off.
+# ------------------------------------------------------------
+PDF_PREWARM = os.environ.get("NIRNAY_PDF_PREWARM", "1") != "0"
+PDF_WARMUP_TIMEOUT_S = 120
+
+
+class PdfEngineWarmup:
+    LABELS = {
+        "checking": "checking Chromium",
+        "installing": "installing Chromium",
+        "warming": "starting browser",
+        "ready": "ready",
+        "failed": "not available",
+    }
+
+    def __init__(self, pool: BrowserPool):
+        self.state = "checking"
+        self.error: str | None = None
+        self.seconds: float | None = None
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(pool,), name="pdf-warmup", daemon=True)
+        self._thread.start()
+
+    @property
+    def label(self) -> str:
+        return self.LABELS[self.state]
+
+    def wait(self, timeout: float | None = None) -> bool:
+        return self._done.wait(timeout)
+
+    def _run(self, pool: BrowserPool) -> None:
+        t0 = time.perf_counter()
+        try:
+            if not chromium_installed():
+                self.state = "installing"
+                install_chromium()
+            self.state = "warming"
+            pool.run(print_pdf, full_document("Nirnay", "<p>warm-up</p>"), timeout=PDF_WARMUP_TIMEOUT_S)
+            self.state = "ready"
+        except Exception as e:
+            self.state = "failed"
+            self.error = str(e)
+        finally:
+            self.seconds = time.perf_counter() - t0
+            self._done.set()
+
+
+@st.cache_resource
+def get_pdf_engine() -> PdfEngineWarmup:
+    return PdfEngineWarmup(get_browser_pool())
+
+
+# The HTML is handed to the page in memory. Everything local is already
+# inlined, so instead of networkidle (>= 500 ms of idle) we wait for exactly
+# what affects layout: web fonts and image decoding, capped by a deadline
+# for slow remote images.
+PDF_READY_TIMEOUT_MS = int(os.environ.get("NIRNAY_PDF_READY_MS", "10000"))
+
+PDF_READY_JS = """
+(timeout) => {
+  const images = Array.from(document.images, (img) => img.decode().catch(() => {}));
+  const ready = Promise.all([document.fonts.ready, ...images]);
+  return Promise.race([ready, new Promise((r) => setTimeout(r, timeout))]);
+}
+"""
+
+
+# ------------------------------------------------------------
+# Remote images
+#    - Left alone by the inliner, so Chromium used to fetch them one by one
+#      inside every print, and one slow host stalled the whole job.
+#    - Before printing, all remote <img> URLs are fetched concurrently
+#      (REMOTE_IMAGE_CONCURRENCY at a time, REMOTE_IMAGE_TIMEOUT_S each)
+#      into the render cache: bodies by content hash, plus a small record
+#      per URL with ETag / Last-Modified and an expiry from Cache-Control
+#      or Expires (REMOTE_IMAGE_TTL_S when the server gives neither).
+#    - Fresh entries cost no request; expired ones are revalidated with a
+#      conditional GET. Chromium's requests are answered from the cache;
+#      URLs that just failed are aborted instead of retried.
+#    - NIRNAY_REMOTE_IMAGES=0 leaves remote images to Chromium as before.
+# ------------------------------------------------------------
+REMOTE_IMAGES = os.environ.get("NIRNAY_REMOTE_IMAGES", "1") != "0"
+REMOTE_IMAGE_CONCURRENCY = int(os.environ.get("NIRNAY_REMOTE_CONCURRENCY", "8"))
+REMOTE_IMAGE_TIMEOUT_S = float(os.environ.get("NIRNAY_REMOTE_TIMEOUT_S", "10"))
+REMOTE_IMAGE_TTL_S = 24 * 3600
+REMOTE_IMAGE_MAX_MB = 20
+REMOTE_IMAGE_FAILURE_TTL_S = 60
+REMOTE_IMG_SRC = re.compile(r"""<img\b[^>]*?\bsrc\s*=\s*["'](https?://[^"']+)["']""", re.IGNORECASE)
+REMOTE_URL = re.compile(r"^https?://")
+CACHE_MAX_AGE = re.compile(r"max-age\s*=\s*(\d+)")
+
+
+def remote_image_urls(full_html: str) -> list[str]:
+    return list(dict.fromkeys(html_unescape(m) for m in REMOTE_IMG_SRC.findall(full_html)))
+
+
+def remote_expiry(headers, now: float) -> float | None:
+    # None: the response must not be stored.
+    cache_control = (headers.get("Cache-Control") or "").lower()
+    if "no-store" in cache_control:
+        return None
+    if "no-cache" in cache_control:
+        return now
+    m = CACHE_MAX_AGE.search(cache_control)
+    if m:
+        return now + int(m.group(1))
+    if headers.get("Expires"):
+        try:
+            return parsedate_to_datetime(headers["Expires"]).timestamp()
+        except (TypeError, ValueError):
+            return now  # unparseable Expires means "already expired"
+    return now + REMOTE_IMAGE_TTL_S
+
+
+def fetch_remote_image(url: str, record: dict | None, timeout: float) -> tuple[int, object, bytes]:
+    # Blocking GET (runs on a worker thread); conditional when a record exists.
+    # The body is read piecewise against one deadline, so a host trickling
+    # bytes can't keep the call going past timeout (plus one socket read).
+    deadline = time.monotonic() + timeout
+    request = urllib.request.Request(url, headers={"User-Agent": "nirnay-pdf", "Accept": "image/*"})
+    if record is not None:
+        if record.get("etag"):
+            request.add_header("If-None-Match", record["etag"])
+        if record.get("last_modified"):
+            request.add_header("If-Modified-Since", record["last_modified"])
+    limit = REMOTE_IMAGE_MAX_MB * 1024 * 1024
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as resp:
+            chunks, size = [], 0
+            while True:
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"no complete response within {timeout:g} s")
+                chunk = resp.read1(64 * 1024)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                size += len(chunk)
+                if size > limit:
+                    raise ValueError(f"larger than {REMOTE_IMAGE_MAX_MB} MB")
+            return resp.status, resp.headers, b"".join(chunks)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return 304, e.headers, b""
+        raise
+
+
+class RemoteImages:
+    def __init__(
+        self,
+        cache: "RenderCache | None" = None,
+        concurrency: int = REMOTE_IMAGE_CONCURRENCY,
+        timeout_s: float = REMOTE_IMAGE_TIMEOUT_S,
+    ):
+        self.cache = cache
+        self.concurrency = concurrency
+        self.timeout_s = timeout_s
+        self.fetched = 0
+        self.revalidated = 0
+        self.fresh = 0
+        self._failed: dict[str, float] = {}  # url → monotonic time of failure
+        self._lock = threading.Lock()
+        # Not asyncio's default executor: asyncio.run() joins that one on
+        # exit, which would make a print wait for a fetch it gave up on.
+        # Abandoned fetches still hold a thread until their deadline, hence
+        # the headroom over the concurrency limit.
+        self._executor = ThreadPoolExecutor(max_workers=2 * concurrency, thread_name_prefix="nirnay-remote")
+
+    def _cache(self) -> "RenderCache":
+        if self.cache is None:
+            self.cache = get_render_cache()
+        return self.cache
+
+    @staticmethod
+    def _record_key(url: str) -> str:
+        return hashlib.sha256(b"remote-image\0" + url.encode("utf-8")).hexdigest()
+
+    def _record(self, url: str) -> dict | None:
+        raw = self._cache().get(self._record_key(url))
+        return json.loads(raw) if raw is not None else None
+
+    def cached(self, url: str) -> tuple[bytes, str] | None:
+        # Stored body for url, fresh or not; never touches the network.
+        record = self._record(url)
+        if record is None:
+            return None
+        data = self._cache().get(record["sha256"])
+        return (data, record["mime"]) if data is not None else None
+
+    def failed(self, url: str) -> bool:
+        with self._lock:
+            at = self._failed.get(url)
+        return at is not None and time.monotonic() - at < REMOTE_IMAGE_FAILURE_TTL_S
+
+    def _store(self, url: str, headers, data: bytes, record: dict | None, now: float) -> None:
+        expires = remote_expiry(headers, now)
+        if expires is None:
+            return
+        cache = self._cache()
+        if data:
+            mime = (headers.get("Content-Type") or "").split(";")[0].strip().lower()
+            if not mime.startswith("image/"):
+                mime = IMAGE_MIME.get(posixpath.splitext(url.split("?")[0])[1].lower(), "")
+            if not mime:
+                raise ValueError("not an image")
+            digest = hashlib.sha256(data).hexdigest()
+            cache.put(digest, data)
+            record = {"sha256": digest, "mime": mime}
+        record = {
+            **record,
+            "etag": headers.get("ETag") or record.get("etag"),
+            "last_modified": headers.get("Last-Modified") or record.get("last_modified"),
+            "expires": expires,
+        }
+        cache.put(self._record_key(url), json.dumps(record).encode("utf-8"))
+
+    async def _get(self, url: str, sem: asyncio.Semaphore) -> bool:
+        record = self._record(url)
+        if record is not None and self._cache().get(record["sha256"]) is None:
+            record = None  # body evicted: fetch unconditionally
+        if record is not None and record["expires"] > time.time():
+            self.fresh += 1
+            return True
+        try:
+            async with sem:
+                fetch = asyncio.get_running_loop().run_in_executor(
+                    self._executor, fetch_remote_image, url, record, self.timeout_s
+                )
+                status, headers, data = await asyncio.wait_for(fetch, self.timeout_s)
+            if status == 304 and record is None:
+                raise ValueError("304 without a cached copy")
+            if status != 304 and not data:
+                raise ValueError("empty response body")
+            self._store(url, headers, data if status != 304 else b"", record, time.time())
+        except (OSError, ValueError, asyncio.TimeoutError, http.client.HTTPException):
+            with self._lock:
+                self._failed[url] = time.monotonic()
+            # A stale copy beats no image.
+            return record is not None
+        with self._lock:
+            self._failed.pop(url, None)
+            if status == 304:
+                self.revalidated += 1
+            else:
+                self.fetched += 1
+        return True
+
+    async def prefetch(self, urls: list[str]) -> dict[str, bool]:
+        # {url: usable from the cache}
+        sem = asyncio.Semaphore(self.concurrency)
+        ok = await asyncio.gather(*(self._get(url, sem) for url in urls))
+        return dict(zip(urls, ok))
+
+    def stats(self) -> dict:
+        with self._lock:
+            failed = len(self._failed)
+        return {"fetched": self.fetched, "revalidated": self.revalidated, "fresh": self.fresh, "failed": failed}
+
+
+@st.cache_resource
+def get_remote_images() -> RemoteImages:
+    return RemoteImages()
+
+
+def prefetch_remote_images(full_html: str) -> dict[str, bool]:
+    # Called from the submitting thread, never from a browser thread
+    # (Playwright's sync API owns that thread's event loop).
+    urls = remote_image_urls(full_html) if REMOTE_IMAGES else []
+    if not urls:
+        return {}
+    with stage("pdf:images"):
+        return asyncio.run(get_remote_images().prefetch(urls))
+
+
+def serve_remote_images(route) -> None:
+    # Playwright route handler for http(s) requests made while printing.
+    remote = get_remote_images()
+    url = route.request.url
+    hit = remote.cached(url)
+    if hit is not None:
+        data, mime = cached_optimize_image(*hit)
+        route.fulfill(status=200, content_type=mime, body=data)
+    elif remote.failed(url):
+        route.abort()
+    else:
+        route.continue_()
+
+
+def print_pdf(browser, full_html: str) -> bytes:
+    # Higher scale helps text crispness; images remain their true pixels (no forced upscaling)
+    context = browser.new_context(device_scale_factor=2)
+    try:
+        page = context.new_page()
+        if REMOTE_IMAGES:
+            page.route(REMOTE_URL, serve_remote_images)
+        with stage("pdf:load"):
+            page.set_content(full_html, wait_until="domcontentloaded")
+            page.evaluate(PDF_READY_JS, PDF_READY_TIMEOUT_MS)
+        page.emulate_media(media="print")
+
+        # Let @page margins apply
+        with stage("pdf:print"):
+            return page.pdf(
                 format="A4",
                 print_background=True,
                 prefer_css_page_size=True,
                 margin={"top": "0mm", "bottom": "0mm", "left": "0mm", "right": "0mm"},
             )
+    finally:
+        context.close()
+
+
+def html_to_pdf_bytes(full_html: str, pool: BrowserPool | None = None, timeout: float | None = None) -> bytes:
+    pool = pool or get_browser_pool()
+    prefetch_remote_images(full_html)
+    return pool.run(print_pdf, full_html, timeout=timeout)
+
+
+# ------------------------------------------------------------
+# Chunked PDF for large compilations
+#    - The document is cut at top-level .page-break markers. Those already
+#      force a new page, so the pieces paginate exactly like one pass. A
+#      daily has just one (after the Index), so it splits in two; the
+#      compilations of section 16 add one before every day.
+#    - topics_per_chunk additionally cuts before every Nth topic title. That
+#      makes each group of topics start on a fresh page, so it is opt-in.
+#    - Pieces print concurrently on the browser pool (size it to the cores
+#      you want to use) and are stitched in order with pypdf. Without pypdf,
+#      or with nothing to cut, this is a plain html_to_pdf_bytes().
+# ------------------------------------------------------------
+PROSE_OPEN = '<div class="prose">\n        '
+PROSE_CLOSE = "\n      </div>\n    </article>"
+PAGE_BREAK_HTML = '<div class="page-break"></div>'
+# Top-level structure of serialized body markup (balanced, bs4 output):
+# topic titles, <div> nesting and comments (skipped, they may hold markup).
+TOP_LEVEL_TOKEN = re.compile(
+    r'(?P<topic><h2\b[^>]*\bclass="(?:[^"]*\s)?topic-title(?:\s[^"]*)?"[^>]*>(?P<title>.*?)</h2>)'
+    r"|(?P<open><div\b[^>]*>)|(?P<close></div>)|(?P<comment><!--.*?-->)",
+    re.S,
+)
+CLASS_ATTR = re.compile(r'\bclass="([^"]*)"')
+
+
+def fragment_nodes(soup: BeautifulSoup) -> list:
+    if soup.builder.NAME != "html.parser" and soup.body is not None:
+        return list(soup.body.contents)
+    return list(soup.contents)
+
+
+def split_html_for_print(full_html: str, topics_per_chunk: int | None = None) -> list[str]:
+    start = full_html.find(PROSE_OPEN)
+    end = full_html.rfind(PROSE_CLOSE)
+    if start < 0 or end < start:
+        return [full_html]
+    head, body, tail = full_html[: start + len(PROSE_OPEN)], full_html[start + len(PROSE_OPEN): end], full_html[end:]
+
+    # Slices of the body string itself; nothing is parsed or re-serialized.
+    pieces: list[str] = []
+    pos = 0           # start of the current piece
+    topics = 0
+    depth = 0
+    break_at = None   # start of an open top-level page-break div
+    for tok in TOP_LEVEL_TOKEN.finditer(body):
+        if tok.group("comment") is not None:
+            continue
+        if tok.group("open") is not None:
+            if depth == 0:
+                classes = CLASS_ATTR.search(tok.group("open"))
+                if classes and "page-break" in classes.group(1).split():
+                    break_at = tok.start()
+            depth += 1
+        elif tok.group("close") is not None and depth > 0:
+            depth -= 1
+            if depth == 0 and break_at is not None:
+                # The page-break itself is dropped: each piece starts a page anyway.
+                pieces.append(body[pos:break_at])
+                pos, break_at, topics = tok.end(), None, 0
+        elif depth == 0 and tok.group("topic") is not None and topics_per_chunk:
+            if topics and topics % topics_per_chunk == 0:
+                pieces.append(body[pos: tok.start()])
+                pos = tok.start()
+            topics += 1
+    pieces.append(body[pos:])
+
+    pieces = [p for p in pieces if p.strip()]
+    if len(pieces) < 2:
+        return [full_html]
+    return [head + p + tail for p in pieces]
+
+
+def merge_pdfs(parts: list[bytes]) -> bytes:
+    from pypdf import PdfReader, PdfWriter  # pip: pypdf
+
+    writer = PdfWriter()
+    for part in parts:
+        writer.append(PdfReader(io.BytesIO(part)))
+    out = io.BytesIO()
+    writer.write(out)
+    return out.getvalue()
+
+
+def html_to_pdf_bytes_chunked(
+    full_html: str,
+    pool: BrowserPool | None = None,
+    topics_per_chunk: int | None = None,
+    timeout: float | None = None,
+    on_parts=None,
+) -> bytes:
+    # on_parts(done, total) is called as pieces finish (progress reporting).
+    try:
+        import pypdf  # noqa: F401  (pip: pypdf)
+    except ImportError:
+        return html_to_pdf_bytes(full_html, pool, timeout)
+
+    with stage("pdf:split"):
+        pieces = split_html_for_print(full_html, topics_per_chunk)
+    if len(pieces) == 1:
+        return html_to_pdf_bytes(full_html, pool, timeout)
+
+    pool = pool or get_browser_pool()
+    deadline = None if timeout is None else time.monotonic() + timeout
+    prefetch_remote_images(full_html)
+    futures = [pool.submit(print_pdf, piece) for piece in pieces]
+    parts = []
+    try:
+        for f in futures:
+            left = None if deadline is None else max(0.0, deadline - time.monotonic())
+            parts.append(f.result(timeout=left))
+            if on_parts is not None:
+                on_parts(len(parts), len(pieces))
+    except BaseException:
+        for f in futures:
+            pool.abandon(f)
+        raise
 
-            browser.close()
-
-        return pdf_bytes
+    with stage("pdf:merge"):
+        return merge_pdfs(parts)
 
 
 # ============================================================
-# UI
+# 12) Render cache (content-addressed: memory LRU + disk)
+#    - Streamlit reruns the script on every widget click; identical uploads
+#      should not go through markdown/soup/Chromium again.
+#    - HTML is keyed on the markdown bytes + CSS + pipeline options,
+#      PDF on the final HTML bytes (which already embed the CSS).
 # ============================================================
-st.title("Nirnay Daily CA — Markdown to HTML + PDF (Single Column)")
-st.caption("Upload a .md file → consistent Nirnay HTML + PDF (no MD edits required).")
+PIPELINE_VERSION = "4"  # bump when a transform changes its output
+CSS_VERSION = hashlib.sha256(STANDARD_CSS.encode("utf-8")).hexdigest()[:12]
+
+RENDER_CACHE_DIR = Path(os.environ.get("NIRNAY_CACHE_DIR") or Path(tempfile.gettempdir()) / "nirnay-cache")
+RENDER_CACHE_MEM_MB = 128
+RENDER_CACHE_DISK_MB = 1024
+
+
+def image_key_options() -> dict:
+    # Image settings that change every document embedding an image
+    return {"max_px": IMAGE_MAX_PX, "fmt": IMAGE_REENCODE, "quality": IMAGE_QUALITY}
+
+
+def image_cache_key(data: bytes, mime: str) -> str:
+    # Processed images depend only on the source bytes and the image
+    # settings, not on CSS, pipeline version, renderer or parser.
+    h = hashlib.sha256(f"image|{mime}".encode("utf-8"))
+    for k, v in sorted(image_key_options().items()):
+        h.update(f"|{k}={v!r}".encode("utf-8"))
+    h.update(b"\0")
+    h.update(data)
+    return h.hexdigest()
+
+
+def content_key(kind: str, payload: bytes, **options) -> str:
+    h = hashlib.sha256()
+    h.update(f"{kind}|{PIPELINE_VERSION}|{CSS_VERSION}|{MARKDOWN_RENDERER.name}|{PARSER_BACKEND}".encode("utf-8"))
+    for k in sorted(options):
+        h.update(f"|{k}={options[k]!r}".encode("utf-8"))
+    h.update(b"\0")
+    h.update(payload)
+    return h.hexdigest()
+
+
+class RenderCache:
+    def __init__(
+        self,
+        directory: Path | None = RENDER_CACHE_DIR,
+        mem_limit_mb: float = RENDER_CACHE_MEM_MB,
+        disk_limit_mb: float = RENDER_CACHE_DISK_MB,
+    ):
+        self.directory = Path(directory) if directory else None
+        self.mem_limit = int(mem_limit_mb * 1024 * 1024)
+        self.disk_limit = int(disk_limit_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self._mem: OrderedDict[str, bytes] = OrderedDict()
+        self._mem_bytes = 0
+        self._disk_bytes = 0
+        self._evicting = False
+        self._lock = threading.Lock()
+
+        if self.directory is not None:
+            try:
+                self.directory.mkdir(parents=True, exist_ok=True)
+                self._disk_bytes = sum(f.stat().st_size for f in self._disk_files())
+            except OSError:
+                # Read-only / unavailable disk: memory tier only.
+                self.directory = None
+
+    def _disk_files(self):
+        return [f for f in self.directory.glob("*/*") if f.is_file() and not f.name.endswith(".tmp")]
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / key
+
+    def _mem_put(self, key: str, value: bytes) -> None:
+        old = self._mem.pop(key, None)
+        if old is not None:
+            self._mem_bytes -= len(old)
+        if len(value) > self.mem_limit:
+            return
+        self._mem[key] = value
+        self._mem_bytes += len(value)
+        while self._mem_bytes > self.mem_limit:
+            _, evicted = self._mem.popitem(last=False)
+            self._mem_bytes -= len(evicted)
+
+    # The lock covers the memory LRU and the counters only; disk reads and
+    # writes run outside it (every writer has its own temp file), so a slow
+    # disk never holds up memory hits in other threads.
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            value = self._mem.get(key)
+            if value is not None:
+                self._mem.move_to_end(key)
+                self.hits += 1
+                return value
+
+        if self.directory is not None:
+            path = self._path(key)
+            try:
+                value = path.read_bytes()
+                os.utime(path)  # LRU order on disk follows mtime
+            except OSError:
+                value = None
+
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self._mem_put(key, value)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value: bytes) -> None:
+        with self._lock:
+            self._mem_put(key, value)
+        if self.directory is None or len(value) > self.disk_limit:
+            return
+
+        path = self._path(key)
+        try:
+            path.parent.mkdir(exist_ok=True)
+            old_size = path.stat().st_size if path.exists() else 0
+            # Unique per writer: forked workers share thread idents.
+            fd, tmp = tempfile.mkstemp(prefix=f"{key}.", suffix=".tmp", dir=path.parent)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(value)
+                os.replace(tmp, path)
+            except OSError:
+                Path(tmp).unlink(missing_ok=True)
+                raise
+        except OSError:
+            return
+
+        with self._lock:
+            self._disk_bytes += len(value) - old_size
+            evict = self._disk_bytes > self.disk_limit and not self._evicting
+            if evict:
+                self._evicting = True
+        if evict:
+            try:
+                self._evict_disk()
+            finally:
+                with self._lock:
+                    self._evicting = False
+
+    def _evict_disk(self) -> None:
+        # Runs in one thread at a time, outside the lock.
+        files = []
+        for f in self._disk_files():
+            try:
+                info = f.stat()
+            except OSError:
+                continue
+            files.append((info.st_mtime, info.st_size, f))
+        files.sort()
+
+        total = sum(size for _, size, _ in files)
+        for _, size, f in files:
+            if total <= self.disk_limit:
+                break
+            try:
+                f.unlink()
+                total -= size
+            except OSError:
+                pass
+        with self._lock:
+            self._disk_bytes = total
 
-uploaded = st.file_uploader("Upload Markdown file", type=["md", "markdown"])
 
-if uploaded:
-    md_text = uploaded.read().decode("utf-8", errors="ignore")
-    base_name = Path(uploaded.name).stem
+@st.cache_resource
+def get_render_cache() -> RenderCache:
+    return RenderCache()
+
+
+def cached_md_to_full_html(
+    md_text: str,
+    title_fallback: str,
+    md_filename: str | None = None,
+    cache: RenderCache | None = None,
+    assets=None,
+) -> str:
+    return cached_md_to_html_bytes(md_text, title_fallback, md_filename, cache, assets).decode("utf-8")
+
+
+def html_cache_key(md_text: str, title_fallback: str, md_filename: str | None = None, assets=None) -> str:
+    # Also what batch.py's manifest and the archive index compare against.
+    options = {"title_fallback": title_fallback, "md_filename": md_filename, **image_key_options()}
+    assets = resolve_assets(md_filename, assets)
+    if assets is not None:
+        # Image refs as the renderer sees them: cleanup unescapes \! \[ \( etc.
+        options["assets"] = assets.content_fingerprint(cleanup_markdown(md_text))
+    return content_key("html", md_text.encode("utf-8"), **options)
+
+
+def cached_md_to_html_bytes(
+    md_text: str,
+    title_fallback: str,
+    md_filename: str | None = None,
+    cache: RenderCache | None = None,
+    assets=None,
+) -> bytes:
+    # UTF-8 document as stored in the cache (what downloads and keys need).
+    cache = cache or get_render_cache()
+    key = html_cache_key(md_text, title_fallback, md_filename, assets)
+    hit = cache.get(key)
+    if hit is not None:
+        return hit
+
+    # Near-identical re-uploads still reuse every unchanged topic.
+    html_bytes = md_to_full_html_incremental(
+        md_text, title_fallback=title_fallback, md_filename=md_filename, cache=cache, assets=assets
+    ).encode("utf-8")
+    cache.put(key, html_bytes)
+    return html_bytes
+
+
+def pdf_cache_key(full_html: str | bytes, topics_per_chunk: int | None = None) -> str:
+    # Cutting only at page breaks paginates like a single pass; cutting
+    # between topics does not, so that gets its own entry.
+    payload = full_html if isinstance(full_html, bytes) else full_html.encode("utf-8")
+    if topics_per_chunk:
+        return content_key("pdf", payload, topics_per_chunk=topics_per_chunk)
+    return content_key("pdf", payload)
+
+
+def cached_html_to_pdf_bytes(
+    full_html: str,
+    cache: RenderCache | None = None,
+    chunked: bool = False,
+    topics_per_chunk: int | None = None,
+    timeout: float | None = None,
+    on_parts=None,
+    use_cache: bool = True,
+) -> bytes:
+    cache = cache or get_render_cache()
+    topics_per_chunk = topics_per_chunk if chunked else None
+    key = pdf_cache_key(full_html, topics_per_chunk)
+    hit = cache.get(key) if use_cache else None
+    if hit is not None:
+        return hit
+
+    if chunked:
+        pdf_bytes = html_to_pdf_bytes_chunked(
+            full_html, topics_per_chunk=topics_per_chunk, timeout=timeout, on_parts=on_parts
+        )
+    else:
+        pdf_bytes = html_to_pdf_bytes(full_html, timeout=timeout)
+    cache.put(key, pdf_bytes)
+    return pdf_bytes
+
+
+# ------------------------------------------------------------
+# Render queue shared by all sessions
+#    - At most PDF_QUEUE_CONCURRENCY documents print at once; the rest wait
+#      in FIFO order, so each session can show its queue position.
+#    - A request for a PDF that is already being rendered (same cache key)
+#      joins the in-flight job instead of printing it again.
+#    - PDF_JOB_TIMEOUT_S bounds each job from the moment it starts. Pieces
+#      not yet picked up are dropped; a piece already printing is abandoned
+#      (BrowserPool.abandon kills that worker's driver and browser), so a
+#      hung print frees its slot instead of holding it forever.
+# ------------------------------------------------------------
+PDF_QUEUE_CONCURRENCY = int(os.environ.get("NIRNAY_PDF_CONCURRENCY", str(PDF_POOL_SIZE)))
+PDF_JOB_TIMEOUT_S = float(os.environ.get("NIRNAY_PDF_TIMEOUT_S", "300"))
+
+
+class RenderJob:
+    def __init__(self, key: str, ctx, kwargs: dict):
+        self.key = key
+        self.future: Future = Future()
+        self.state = "queued"  # queued | running | done
+        self.parts_done = 0
+        self.parts_total = 1
+        self._ctx = ctx
+        self._kwargs = kwargs
+
+    def on_parts(self, done: int, total: int) -> None:
+        self.parts_done, self.parts_total = done, total
+
+
+class RenderQueue:
+    def __init__(self, concurrency: int = PDF_QUEUE_CONCURRENCY, timeout_s: float | None = PDF_JOB_TIMEOUT_S):
+        self.concurrency = max(1, concurrency)
+        self.timeout_s = timeout_s
+        self._pending: deque[RenderJob] = deque()
+        self._inflight: dict[str, RenderJob] = {}
+        self._cond = threading.Condition()
+        self._runners = [
+            threading.Thread(target=self._runner, name=f"pdf-queue-{i}", daemon=True)
+            for i in range(self.concurrency)
+        ]
+        for r in self._runners:
+            r.start()
+
+    def submit(
+        self,
+        full_html: str,
+        chunked: bool = False,
+        topics_per_chunk: int | None = None,
+        use_cache: bool = True,
+    ) -> RenderJob:
+        key = pdf_cache_key(full_html, topics_per_chunk if chunked else None)
+        if not use_cache:
+            key += ":uncached"  # profiled runs must really print
+        with self._cond:
+            job = self._inflight.get(key)
+            if job is not None:
+                return job
+            kwargs = {
+                "full_html": full_html,
+                "chunked": chunked,
+                "topics_per_chunk": topics_per_chunk,
+                "use_cache": use_cache,
+            }
+            job = self._inflight[key] = RenderJob(key, copy_context(), kwargs)
+            self._pending.append(job)
+            self._cond.notify()
+            return job
+
+    def position(self, job: RenderJob) -> int:
+        # 1-based place in line; 0 once it is running or finished.
+        with self._cond:
+            try:
+                return self._pending.index(job) + 1
+            except ValueError:
+                return 0
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "concurrency": self.concurrency,
+                "queued": len(self._pending),
+                "running": sum(1 for j in self._inflight.values() if j.state == "running"),
+            }
+
+    def _runner(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                job = self._pending.popleft()
+                job.state = "running"
+
+            try:
+                result = job._ctx.run(
+                    lambda: cached_html_to_pdf_bytes(timeout=self.timeout_s, on_parts=job.on_parts, **job._kwargs)
+                )
+            except BaseException as e:
+                job.future.set_exception(e)
+            else:
+                job.future.set_result(result)
+            finally:
+                job.state = "done"
+                with self._cond:
+                    self._inflight.pop(job.key, None)
 
-    full_html = md_to_full_html(md_text, title_fallback=base_name)
 
-    st.success("Rendered HTML successfully.")
+@st.cache_resource
+def get_render_queue() -> RenderQueue:
+    return RenderQueue()
 
-    with st.expander("Preview (HTML)", expanded=False):
-        st.components.v1.html(full_html, height=650, scrolling=True)
 
-    st.download_button(
-        "Download HTML",
-        data=full_html.encode("utf-8"),
-        file_name=f"{base_name}_nirnay.html",
-        mime="text/html",
+# ============================================================
+# 13) Incremental per-topic rendering
+#    - The markdown is cleaned first, then split right before each top-level
+#      H2 and every piece (one topic, plus the preamble) is rendered on its
+#      own and cached by content hash, so re-uploading a file with a one-line
+#      fix re-renders only the topic that changed. Splitting the cleaned text
+#      matters: cleanup drops blank lines and empty headings, which can turn
+#      a safe-looking split point into a table row.
+#    - Safe because nothing in the pipeline crosses an H2: colour boxes stop
+#      at topic/section headings. The two document-wide bits are redone at
+#      assembly time: toc heading ids are made unique again, and the Index
+#      page break is placed from the fragments' comment markers.
+#    - Documents using constructs that do span blocks (reference links,
+#      [TOC], raw HTML blocks) are rendered whole.
+# ============================================================
+TOPIC_SPLIT_UNSAFE = re.compile(
+    r"(?im)^ {0,3}(\[[^\]]+\]:\s|\[TOC\]|<(div|table|section|details|blockquote|pre|figure|aside)\b)"
+)
+ATX_H2 = re.compile(r"^ {0,3}##[ \t]+(.*?)[ \t#]*$")
+FENCE = re.compile(r"^ {0,3}(`{3,}|~{3,})")
+HEADING_ID = re.compile(r'(<h[1-6]\b[^>]*?\bid=")([^"]*)(")')
+TOC_IDCOUNT = re.compile(r"^(.*)_([0-9]+)$")
+
+
+def split_topics(md_text: str) -> list[str] | None:
+    # Pieces that join back to md_text exactly; None when splitting isn't safe.
+    if TOPIC_SPLIT_UNSAFE.search(md_text):
+        return None
+
+    chunks: list[str] = []
+    cur: list[str] = []
+    fence = None
+    prev_blank = True
+    for line in md_text.splitlines(keepends=True):
+        body = line.rstrip("\r\n")
+        m = FENCE.match(body)
+        if fence is not None:
+            if m and m.group(1)[0] == fence[0] and len(m.group(1)) >= len(fence):
+                fence = None
+        elif m:
+            fence = m.group(1)
+        elif prev_blank and cur:
+            h2 = ATX_H2.match(body)
+            if h2 and re.search(r"\w", strip_heading_codes(h2.group(1))):
+                chunks.append("".join(cur))
+                cur = []
+        cur.append(line)
+        prev_blank = not body.strip()
+
+    if cur:
+        chunks.append("".join(cur))
+    return chunks
+
+
+def render_topic_fragment(md_chunk: str, assets, last: bool, memo: dict | None = None) -> dict:
+    # md_chunk is a piece of the already cleaned markdown.
+    body_html = render_markdown(md_chunk)
+    if body_html and not last:
+        # The newline markdown puts between blocks; an open colour box at
+        # the end of the topic absorbs it, exactly as in a whole render.
+        body_html += "\n"
+    soup = parse_html(body_html)
+    apply_transforms(
+        soup,
+        [
+            gridtable_transform,
+            section_transform,
+            image_transform,
+            index_marker_transform,
+            inline_images_transform(assets, memo),
+        ],
     )
+    h1 = soup.find("h1")
+    return {"html": fragment_html(soup), "h1": h1.get_text(" ", strip=True) if h1 else None}
+
+
+def cached_topic_fragment(md_chunk: str, assets, last: bool, cache: RenderCache, memo: dict | None = None) -> dict:
+    fingerprint = assets.content_fingerprint(md_chunk) if assets is not None else None
+    key = content_key("topic", md_chunk.encode("utf-8"), assets=fingerprint, last=last, **image_key_options())
+    hit = cache.get(key)
+    if hit is not None:
+        return json.loads(hit)
+    frag = render_topic_fragment(md_chunk, assets, last, memo)
+    cache.put(key, json.dumps(frag).encode("utf-8"))
+    return frag
+
+
+def uniquify_heading_ids(html: str, used: set[str]) -> str:
+    # Same rule as python-markdown's toc: x, x_1, x_2 ... in document order.
+    def unique(match):
+        hid = match.group(2)
+        while hid in used or not hid:
+            m = TOC_IDCOUNT.match(hid)
+            hid = f"{m.group(1)}_{int(m.group(2)) + 1}" if m else f"{hid}_1"
+        used.add(hid)
+        return match.group(1) + hid + match.group(3)
+
+    return HEADING_ID.sub(unique, html)
+
+
+def iter_assembled_topics(fragments: list[dict]):
+    pb = '<div class="page-break"></div>'
+    marks = {name: f"<!--{name}-->" for name in (PB_MARK_NEXT, PB_MARK_AFTER, PB_MARK_FIRST)}
+
+    # Where the Index page break lands: (fragment index, marker)
+    target = None
+    for i, frag in enumerate(fragments):
+        html = frag["html"]
+        if marks[PB_MARK_NEXT] in html:
+            target = (i, PB_MARK_NEXT)
+        elif marks[PB_MARK_AFTER] in html:
+            later = next((j for j in range(i + 1, len(fragments)) if marks[PB_MARK_FIRST] in fragments[j]["html"]), None)
+            target = (later, PB_MARK_FIRST) if later is not None else (i, PB_MARK_AFTER)
+        if target is not None:
+            break
+
+    used: set[str] = set()
+    for i, frag in enumerate(fragments):
+        html = frag["html"]
+        for name, mark in marks.items():
+            if mark in html:
+                html = html.replace(mark, pb if target == (i, name) else "", 1)
+        yield uniquify_heading_ids(html, used)
+
+
+def assemble_topics(fragments: list[dict]) -> str:
+    return "".join(iter_assembled_topics(fragments))
+
+
+def md_to_full_html_incremental(
+    md_text: str,
+    title_fallback: str,
+    md_filename: str | None = None,
+    cache: RenderCache | None = None,
+    assets=None,
+) -> str:
+    with stage("cleanup_markdown"):
+        cleaned = cleanup_markdown(md_text)
+    chunks = split_topics(cleaned)
+    if not chunks or len(chunks) < 2:
+        return md_to_full_html(md_text, title_fallback=title_fallback, md_filename=md_filename, assets=assets)
+
+    cache = cache or get_render_cache()
+    assets = resolve_assets(md_filename, assets)
+    memo: dict = {}  # an image used by several topics is inlined once
+    with stage("topics"):
+        fragments = [
+            cached_topic_fragment(chunk, assets, i == len(chunks) - 1, cache, memo) for i, chunk in enumerate(chunks)
+        ]
+
+    h1 = next((f["h1"] for f in fragments if f["h1"] is not None), None)
+    doc_title = h1.upper() if h1 is not None else title_fallback.upper()
+
+    with stage("assemble"):
+        return "".join(iter_document(doc_title, iter_assembled_topics(fragments)))
+
+
+# ============================================================
+# 14) Stage profiling (opt-in)
+#    - Wall time, CPU time (of the running thread) and Python heap peak for
+#      every pipeline stage; soup transforms are broken down per transform.
+#      The heap peak is process-wide, so only a stage that opens while no
+#      other traced stage is open (none nested, no other session) gets one.
+#    - stage() is a no-op unless a profiled() block is active, so the normal
+#      path pays nothing.
+#    - Each record is appended to PROFILE_LOG as one JSON line. Documents
+#      slower than PROFILE_SLOW_MS also get a cProfile dump (.prof, readable
+#      with pstats / snakeviz) next to the log.
+# ============================================================
+PROFILE_LOG = Path(os.environ.get("NIRNAY_PROFILE_LOG") or Path(tempfile.gettempdir()) / "nirnay-profile.jsonl")
+PROFILE_SLOW_MS = 5000
+
+
+class PeakTracker:
+    # tracemalloc keeps one peak for the whole process. Resetting it is only
+    # safe when no traced stage is open; the stage that does so owns the peak.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.open = 0
+
+    def enter(self) -> int | None:
+        with self._lock:
+            self.open += 1
+            if self.open > 1:
+                return None
+            tracemalloc.reset_peak()
+            return tracemalloc.get_traced_memory()[0]
+
+    def exit(self, base: int | None) -> int | None:
+        with self._lock:
+            self.open -= 1
+            if base is None or not tracemalloc.is_tracing():
+                return None
+            return tracemalloc.get_traced_memory()[1] - base
+
+
+@st.cache_resource
+def _profile_state() -> tuple[ContextVar, threading.Lock, PeakTracker]:
+    # Streamlit re-executes this file on every rerun, but the cached queue and
+    # browser pool keep calling stage() from the run that created them; one
+    # ContextVar for the whole process lets every run's profiled() see those.
+    return ContextVar("nirnay_profile", default=None), threading.Lock(), PeakTracker()
+
+
+_PROFILE, _PROFILE_LOG_LOCK, _PEAKS = _profile_state()
+
+
+class RenderProfile:
+    def __init__(self, name: str, trace_memory: bool = False):
+        self.name = name
+        self.trace_memory = trace_memory
+        self.started = time.time()
+        self.wall = 0.0
+        self.stages: dict[str, dict] = {}
+        self.dump_path: str | None = None
+        self._lock = threading.Lock()
+
+    def add(self, name: str, wall: float, cpu: float, peak: int | None = None) -> None:
+        with self._lock:
+            entry = self.stages.setdefault(name, {"calls": 0, "wall": 0.0, "cpu": 0.0, "peak": None})
+            entry["calls"] += 1
+            entry["wall"] += wall
+            entry["cpu"] += cpu
+            if peak is not None:
+                entry["peak"] = max(entry["peak"] or 0, peak)
+
+    @contextmanager
+    def stage(self, name: str):
+        tracing = self.trace_memory and tracemalloc.is_tracing()
+        base = _PEAKS.enter() if tracing else None
+        w0, c0 = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            peak = _PEAKS.exit(base) if tracing else None
+            self.add(name, time.perf_counter() - w0, time.thread_time() - c0, peak)
+
+    def timed(self, name: str, fn):
+        # Accumulates many short calls (e.g. per-tag handlers) under one stage.
+        def wrapper(*args, **kwargs):
+            w0, c0 = time.perf_counter(), time.thread_time()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.add(name, time.perf_counter() - w0, time.thread_time() - c0)
+        return wrapper
+
+    def record(self) -> dict:
+        with self._lock:
+            stages = [
+                {
+                    "stage": name,
+                    "calls": e["calls"],
+                    "wall_ms": round(e["wall"] * 1000, 3),
+                    "cpu_ms": round(e["cpu"] * 1000, 3),
+                    "peak_kb": None if e["peak"] is None else round(e["peak"] / 1024, 1),
+                }
+                for name, e in self.stages.items()
+            ]
+        return {
+            "doc": self.name,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            "wall_ms": round(self.wall * 1000, 3),
+            "stages": stages,
+            "cprofile": self.dump_path,
+        }
+
+
+def current_profile() -> RenderProfile | None:
+    return _PROFILE.get()
+
+
+@contextmanager
+def stage(name: str):
+    prof = _PROFILE.get()
+    if prof is None:
+        yield
+        return
+    with prof.stage(name):
+        yield
+
+
+def write_profile_record(record: dict, log_path: Path = PROFILE_LOG) -> None:
+    try:
+        with _PROFILE_LOG_LOCK, open(log_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    except OSError:
+        pass
+
+
+@contextmanager
+def profiled(
+    name: str,
+    trace_memory: bool = False,
+    cprofile: bool = False,
+    log_path: Path | None = PROFILE_LOG,
+    slow_ms: float = PROFILE_SLOW_MS,
+):
+    prof = RenderProfile(name, trace_memory=trace_memory)
+    token = _PROFILE.set(prof)
+
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+
+    profiler = None
+    if cprofile:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already active (e.g. a concurrent session).
+            profiler = None
+
+    t0 = time.perf_counter()
+    try:
+        yield prof
+    finally:
+        prof.wall = time.perf_counter() - t0
+        _PROFILE.reset(token)
+        if started_tracing:
+            tracemalloc.stop()
+
+        if profiler is not None:
+            profiler.disable()
+            if log_path is not None and prof.wall * 1000 >= slow_ms:
+                safe = re.sub(r"[^\w.-]+", "_", name) or "doc"
+                dump = Path(log_path).parent / f"{safe}-{int(prof.started)}.prof"
+                try:
+                    profiler.dump_stats(dump)
+                    prof.dump_path = str(dump)
+                except OSError:
+                    pass
+
+        if log_path is not None:
+            write_profile_record(prof.record(), Path(log_path))
 
-    if st.button("Generate PDF"):
+
+# ============================================================
+# 15) Windowed preview
+#    - The preview shows a few topics at a time instead of the whole page;
+#      topics are cut at the top-level titles section_transform tagged.
+#    - With Streamlit static serving on (.streamlit/config.toml), inlined
+#      images are written once to static/nirnay-preview/<hash>.<ext> and
+#      referenced by URL, so a rerun ships only the window's markup.
+#      Without it they stay inline, still limited to the window.
+# ============================================================
+PREVIEW_ASSET_DIR = Path(__file__).resolve().parent / "static" / "nirnay-preview"
+PREVIEW_ASSET_MB = 256
+PREVIEW_TOPICS = 3
+DATA_URI_SRC = re.compile(r'src="data:(image/[\w.+-]+);base64,([A-Za-z0-9+/=]+)"')
+MIME_EXT = {mime: ext for ext, mime in reversed(list(IMAGE_MIME.items()))}
+
+
+def preview_asset_url(mime: str, b64: str) -> str | None:
+    # Content-addressed file under the static folder; None if unwritable.
+    name = hashlib.sha256(b64.encode("ascii")).hexdigest()[:32] + MIME_EXT.get(mime, ".bin")
+    path = PREVIEW_ASSET_DIR / name
+    if not path.exists():
         try:
-            with st.spinner("Preparing PDF engine (Chromium) ..."):
-                ensure_playwright_chromium()
+            PREVIEW_ASSET_DIR.mkdir(parents=True, exist_ok=True)
+            prune_preview_assets()
+            # Unique per writer: two sessions may publish the same image at once.
+            fd, tmp = tempfile.mkstemp(prefix=f"{name}.", suffix=".tmp", dir=PREVIEW_ASSET_DIR)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(base64.b64decode(b64))
+                os.replace(tmp, path)
+            except OSError:
+                Path(tmp).unlink(missing_ok=True)
+                raise
+        except OSError:
+            return None
+    base = (st.get_option("server.baseUrlPath") or "").strip("/")
+    return f"/{base + '/' if base else ''}app/static/nirnay-preview/{name}"
+
+
+def prune_preview_assets() -> None:
+    # Oldest files go first once the folder is over PREVIEW_ASSET_MB.
+    # Temp files belong to writers still in flight.
+    files = sorted(
+        (f for f in PREVIEW_ASSET_DIR.iterdir() if f.is_file() and not f.name.endswith(".tmp")),
+        key=lambda f: f.stat().st_mtime,
+    )
+    total = sum(f.stat().st_size for f in files)
+    limit = PREVIEW_ASSET_MB * 1024 * 1024
+    for f in files:
+        if total <= limit:
+            break
+        total -= f.stat().st_size
+        f.unlink(missing_ok=True)
+
+
+def externalize_images(html: str) -> str:
+    def by_reference(m):
+        url = preview_asset_url(m.group(1), m.group(2))
+        return f'src="{url}"' if url else m.group(0)
+
+    return DATA_URI_SRC.sub(by_reference, html)
+
+
+class PreviewDocument:
+    # The page split into head, topics and tail for windowed rendering.
+    def __init__(self, full_html: str):
+        start = full_html.find(PROSE_OPEN)
+        end = full_html.rfind(PROSE_CLOSE)
+        if start < 0 or end < start:
+            self.head, self.tail = full_html, ""
+            self.titles, self.topics = ["Document"], [""]
+            return
+        self.head = full_html[: start + len(PROSE_OPEN)]
+        self.tail = full_html[end:]
+
+        self.titles: list[str] = ["Cover"]
+        groups: list[list[str]] = [[]]
+        for node in fragment_nodes(parse_html(full_html[start + len(PROSE_OPEN): end])):
+            if isinstance(node, Tag) and "topic-title" in tag_classes(node):
+                self.titles.append(node.get_text(" ", strip=True) or f"Topic {len(self.titles)}")
+                groups.append([])
+            groups[-1].append(node.decode() if isinstance(node, Tag) else node.output_ready("minimal"))
+        self.topics = ["".join(g) for g in groups]
+        if not self.topics[0].strip() and len(self.topics) > 1:
+            del self.titles[0], self.topics[0]
+
+    def window(self, first: int, count: int = PREVIEW_TOPICS, by_reference: bool = True) -> str:
+        body = "".join(self.topics[first: first + count])
+        if by_reference:
+            body = externalize_images(body)
+        return self.head + body + self.tail
+
+
+@st.cache_resource(max_entries=4, show_spinner=False)
+def get_preview_document(html_key: str, _full_html: str) -> PreviewDocument:
+    # Keyed by content hash; the document itself is not hashed again.
+    return PreviewDocument(_full_html)
+
+
+# ============================================================
+# 16) Weekly / monthly compilations
+#    - Each daily comes from the render cache (rendered once if missing),
+#      so unchanged dailies never go through markdown or soup again.
+#    - Dailies are cut into topics on the topic-title markup with plain
+#      string slicing; their own banner, Index and page break are dropped.
+#    - Topics are renumbered across the range, repeats (same title and same
+#      content) are kept once, heading ids are made unique, and one Index
+#      listing every topic opens the compilation. Only that small head is
+#      parsed, to place the page break via insert_pagebreak_after_index.
+#    - With day_breaks, each later day starts on a new page. Those breaks
+#      are also where a chunked PDF can cut, one piece per day.
+# ============================================================
+DAILY_DATE_PATTERNS = (
+    (re.compile(r"(?<!\d)(\d{4})[-_.]?(\d{2})[-_.]?(\d{2})(?!\d)"), (0, 1, 2)),  # 2024-05-01, 20240501
+    (re.compile(r"(?<!\d)(\d{2})[-_.](\d{2})[-_.](\d{4})(?!\d)"), (2, 1, 0)),     # 01-05-2024
+)
+TOPIC_H2 = re.compile(r'<h2\b[^>]*\bclass="(?:[^"]*\s)?topic-title(?:\s[^"]*)?"[^>]*>(.*?)</h2>', re.S)
+ID_ATTR = re.compile(r'\sid="[^"]*"')
+
+
+def daily_date(path: Path) -> date | None:
+    for pattern, order in DAILY_DATE_PATTERNS:
+        for m in pattern.finditer(path.stem):
+            parts = [int(g) for g in m.groups()]
+            try:
+                return date(parts[order[0]], parts[order[1]], parts[order[2]])
+            except ValueError:
+                continue
+    return None
+
+
+def select_dailies(paths: list[Path], start: date | None = None, end: date | None = None) -> list[tuple[date | None, Path]]:
+    # (date, path) in date order; undated files only when no range is given.
+    dated = [(daily_date(p), p) for p in paths]
+    if start is not None or end is not None:
+        dated = [
+            (d, p) for d, p in dated
+            if d is not None and (start is None or d >= start) and (end is None or d <= end)
+        ]
+    return sorted(dated, key=lambda dp: (dp[0] or date.max, str(dp[1])))
+
+
+def daily_topics(full_html: str) -> list[tuple[str, str, str]]:
+    # [(title text, topic h2 markup, rest of the topic)] of a rendered daily.
+    start = full_html.find(PROSE_OPEN)
+    end = full_html.rfind(PROSE_CLOSE)
+    if start < 0 or end < start:
+        return []
+    body = full_html[start + len(PROSE_OPEN): end]
+
+    heads = list(TOPIC_H2.finditer(body))
+    topics = []
+    for i, m in enumerate(heads):
+        title = m.group(1).strip()
+        if normalize_heading(title) in INDEX_TITLES:
+            continue
+        stop = heads[i + 1].start() if i + 1 < len(heads) else len(body)
+        topics.append((title, m.group(0), body[m.end(): stop]))
+    return topics
+
+
+def compile_dailies(
+    dailies: list[tuple[date | None, Path]],
+    title: str,
+    cache: RenderCache | None = None,
+    day_breaks: bool = True,
+) -> tuple[str, dict]:
+    # (full HTML, stats) for the given (date, path) list, in that order.
+    cache = cache or get_render_cache()
+    stats = {"dailies": 0, "topics": 0, "duplicates": 0, "empty": []}
+    seen: set[tuple[str, str]] = set()
+    used: set[str] = {"compilation", "index"}
+    entries: list[tuple[str, str]] = []  # (id, numbered title)
+    parts: list[str] = []
+
+    for day, path in dailies:
+        md_text = path.read_text(encoding="utf-8", errors="ignore")
+        with stage("compile:daily"):
+            page = cached_md_to_html_bytes(md_text, title_fallback=path.stem, md_filename=str(path), cache=cache)
+        topics = daily_topics(page.decode("utf-8"))
+        stats["dailies"] += 1
+        if not topics:
+            stats["empty"].append(str(path))
+            continue
+
+        first_of_day = True
+        for text, h2, rest in topics:
+            key = (normalize_heading(text), hashlib.sha256(ID_ATTR.sub("", rest).encode("utf-8")).hexdigest())
+            if key in seen:
+                stats["duplicates"] += 1
+                continue
+            seen.add(key)
+            if day_breaks and first_of_day and parts:
+                parts.append(PAGE_BREAK_HTML + "\n")
+            first_of_day = False
+
+            numbered = f"{len(entries) + 1}. {HEADING_NUMBERING.sub('', text).strip()}"
+            h2 = h2[: h2.index(">") + 1] + numbered + "</h2>"
+            h2 = uniquify_heading_ids(h2, used)
+            hid = HEADING_ID.search(h2)
+            entries.append((hid.group(2) if hid else "", numbered))
+            parts.append(h2)
+            parts.append(uniquify_heading_ids(rest, used))
+    stats["topics"] = len(entries)
+
+    items = "".join(
+        f'<li><a href="#{hid}">{numbered}</a></li>' if hid else f"<li>{numbered}</li>"
+        for hid, numbered in entries
+    )
+    head_html = (
+        f'<h1 id="compilation">{html_escape(title)}</h1>\n'
+        f'<h2 class="topic-title" id="index">Index</h2>\n<ul class="compilation-index">{items}</ul>\n'
+    )
+    with stage("compile:index"):
+        # Parsed together with the first topic heading so the break lands
+        # right before it, as in a daily.
+        soup = parse_html(head_html + (parts[0] if parts else ""))
+        insert_pagebreak_after_index(soup)
+        head_html = fragment_html(soup)
+
+    with stage("compile:assemble"):
+        full_html = "".join(iter_document(title.upper(), [head_html, *parts[1:]]))
+    return full_html, stats
+
+
+# ============================================================
+# 17) Document outline (structured record per conversion)
+#    - topic → section kind → plain text, read off the final HTML: topics
+#      are the top-level topic-title headings, sections the top-level
+#      colour boxes (their class is the classify_section kind), anything
+#      else under a topic is "body".
+#    - Works the same for fresh renders, cache hits and compilations. The
+#      markup is bs4-serialized, so tags are balanced and a depth count
+#      over <div>/</div> finds box boundaries without parsing.
+# ============================================================
+OUTLINE_TOKEN = TOP_LEVEL_TOKEN
+OUTLINE_HEADING = re.compile(r"<h[1-6]\b[^>]*>(.*?)</h[1-6]>", re.S)
+MARKUP_TAG = re.compile(r"<[^>]+>")
+
+
+def markup_text(fragment: str) -> str:
+    return WHITESPACE_RUN.sub(" ", html_unescape(MARKUP_TAG.sub(" ", fragment))).strip()
+
+
+def document_outline(full_html: str) -> dict:
+    # {"title", "topics": [{"title", "sections": [{"kind", "heading", "text"}]}]}
+    m = re.search(r"<title>(.*?)</title>", full_html, re.S)
+    outline = {"title": markup_text(m.group(1)) if m else "", "topics": []}
+    start = full_html.find(PROSE_OPEN)
+    end = full_html.rfind(PROSE_CLOSE)
+    if start < 0 or end < start:
+        return outline
+    body = full_html[start + len(PROSE_OPEN): end]
+
+    topic = {"title": "", "sections": []}  # content before the first topic
+    outline["topics"].append(topic)
+
+    def add(kind: str, fragment: str) -> None:
+        h = OUTLINE_HEADING.search(fragment) if kind != "body" else None
+        heading = markup_text(h.group(1)) if h else ""
+        text = markup_text(fragment[: h.start()] + fragment[h.end():] if h else fragment)
+        if text or heading:
+            topic["sections"].append({"kind": kind, "heading": heading, "text": text})
+
+    depth = 0
+    pos = 0           # start of loose top-level content not yet recorded
+    box_kind = None   # kind of the open top-level colour box
+    box_start = 0
+    for tok in OUTLINE_TOKEN.finditer(body):
+        if tok.group("comment") is not None:
+            continue
+        if depth == 0 and tok.group("topic") is not None:
+            add("body", body[pos: tok.start()])
+            topic = {"title": markup_text(tok.group("title")), "sections": []}
+            outline["topics"].append(topic)
+            pos = tok.end()
+        elif tok.group("open") is not None:
+            if depth == 0:
+                classes = CLASS_ATTR.search(tok.group("open"))
+                classes = classes.group(1).split() if classes else []
+                if "colorbox" in classes:
+                    add("body", body[pos: tok.start()])
+                    kinds = [c for c in classes if c != "colorbox"]
+                    box_kind, box_start = (kinds[0] if kinds else "box"), tok.start()
+            depth += 1
+        elif tok.group("close") is not None and depth > 0:
+            depth -= 1
+            if depth == 0 and box_kind is not None:
+                add(box_kind, body[box_start: tok.end()])
+                box_kind = None
+                pos = tok.end()
+    add("body", body[pos:])
+
+    if not outline["topics"][0]["sections"]:
+        del outline["topics"][0]
+    return outline
+
+
+# ============================================================
+# 18) Typed document tree (IR) for downstream jobs
+#    - Topics, sections, gridtables and figures as small __slots__ nodes,
+#      built from the transformed tree the HTML is serialized from, so
+#      quiz / flashcard jobs load structure instead of re-parsing HTML.
+#    - to_dict() / ir_from_dict() round-trip through JSON or msgpack.
+#      Inlined images are referenced by hash, not carried as data URIs.
+# ============================================================
+class IRNode:
+    __slots__ = ()
+    TYPE = ""
+
+    def to_dict(self) -> dict:
+        out = {"type": self.TYPE}
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if isinstance(value, list):
+                value = [v.to_dict() if isinstance(v, IRNode) else v for v in value]
+            out[name] = value
+        return out
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{n}={getattr(self, n)!r}" for n in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class IRText(IRNode):
+    __slots__ = ("tag", "text")
+    TYPE = "text"
+
+    def __init__(self, tag: str, text: str):
+        self.tag = tag
+        self.text = text
 
-            with st.spinner("Rendering PDF ..."):
-                pdf_bytes = html_to_pdf_bytes(full_html)
 
+class IRTable(IRNode):
+    __slots__ = ("header", "rows")
+    TYPE = "table"
+
+    def __init__(self, header: list[str], rows: list[list[str]]):
+        self.header = header
+        self.rows = rows
+
+
+class IRFigure(IRNode):
+    __slots__ = ("src", "sha256", "alt")
+    TYPE = "figure"
+
+    def __init__(self, src: str | None, sha256: str | None, alt: str):
+        self.src = src
+        self.sha256 = sha256
+        self.alt = alt
+
+
+class IRSection(IRNode):
+    __slots__ = ("kind", "heading", "blocks")
+    TYPE = "section"
+
+    def __init__(self, kind: str, heading: str, blocks: list):
+        self.kind = kind
+        self.heading = heading
+        self.blocks = blocks
+
+
+class IRTopic(IRNode):
+    __slots__ = ("title", "id", "blocks")
+    TYPE = "topic"
+
+    def __init__(self, title: str, id: str | None, blocks: list):
+        self.title = title
+        self.id = id
+        self.blocks = blocks
+
+
+class IRDocument(IRNode):
+    __slots__ = ("title", "topics")
+    TYPE = "document"
+
+    def __init__(self, title: str, topics: list):
+        self.title = title
+        self.topics = topics
+
+
+IR_TYPES = {cls.TYPE: cls for cls in (IRText, IRTable, IRFigure, IRSection, IRTopic, IRDocument)}
+IR_BLOCK_TAGS = {"p", "li", "pre", "h3", "h4", "h5", "h6", "dt", "dd"}
+
+
+def ir_from_dict(data: dict) -> IRNode:
+    cls = IR_TYPES[data["type"]]
+    args = []
+    for name in cls.__slots__:
+        value = data.get(name)
+        if isinstance(value, list):
+            value = [ir_from_dict(v) if isinstance(v, dict) and "type" in v else v for v in value]
+        args.append(value)
+    return cls(*args)
+
+
+def ir_figure(img) -> IRFigure:
+    src = img.get("src") or ""
+    if src.startswith("data:"):
+        return IRFigure(None, hashlib.sha256(src.encode("utf-8")).hexdigest(), img.get("alt") or "")
+    return IRFigure(src, None, img.get("alt") or "")
+
+
+def ir_blocks(node, out: list) -> None:
+    # Append the IR blocks for one node of the transformed tree.
+    if not isinstance(node, Tag):
+        text = str(node).strip() if type(node) is NavigableString else ""
+        if text:
+            out.append(IRText("p", text))
+        return
+    classes = tag_classes(node)
+    if "page-break" in classes:
+        return
+    if "gridtable" in classes:
+        header, rows = [], []
+        for row in node.find_all("div", class_="gt-row", recursive=False):
+            cells = [c.get_text(" ", strip=True) for c in row.find_all("div", class_="gt-cell", recursive=False)]
+            if "gt-head" in tag_classes(row):
+                header = cells
+            else:
+                rows.append(cells)
+        out.append(IRTable(header, rows))
+        return
+    if node.name == "img":
+        out.append(ir_figure(node))
+        return
+    if node.name in IR_BLOCK_TAGS or node.name == "h2":
+        # Leaf text block, unless it holds figures / tables of its own
+        if node.find(["img", "div"]) is None:
+            text = node.get_text(" ", strip=True)
+            if text:
+                out.append(IRText(node.name, text))
+            return
+    for child in node.children:
+        ir_blocks(child, out)
+
+
+def document_ir(doc_title: str, soup: BeautifulSoup) -> IRDocument:
+    root = soup.body if soup.builder.NAME != "html.parser" and soup.body is not None else soup
+    topic = IRTopic("", None, [])  # content before the first topic
+    topics = [topic]
+    for node in root.contents:
+        if isinstance(node, Tag) and node.name == "h2" and "topic-title" in tag_classes(node):
+            topic = IRTopic(node.get_text(" ", strip=True), node.get("id"), [])
+            topics.append(topic)
+        elif isinstance(node, Tag) and "colorbox" in tag_classes(node):
+            kinds = [c for c in tag_classes(node) if c != "colorbox"]
+            heading, blocks = "", []
+            for child in node.children:
+                if not heading and getattr(child, "name", None) in HEADING_TAGS:
+                    heading = child.get_text(" ", strip=True)
+                else:
+                    ir_blocks(child, blocks)
+            topic.blocks.append(IRSection(kinds[0] if kinds else "box", heading, blocks))
+        else:
+            ir_blocks(node, topic.blocks)
+    if not topics[0].blocks:
+        del topics[0]
+    return IRDocument(doc_title, topics)
+
+
+def md_to_full_html_with_ir(
+    md_text: str, title_fallback: str, md_filename: str | None = None, assets=None
+) -> tuple[str, IRDocument]:
+    # The page and its IR from one render; the IR walk reuses the tree.
+    doc_title, soup = render_document(md_text, title_fallback, md_filename, assets)
+    with stage("serialize"):
+        full_html = "".join(iter_document(doc_title, iter_fragment_html(soup)))
+    with stage("ir"):
+        ir = document_ir(doc_title, soup)
+    return full_html, ir
+
+
+def ir_to_json(doc: IRNode) -> str:
+    return json.dumps(doc.to_dict(), ensure_ascii=False, separators=(",", ":"))
+
+
+def ir_to_msgpack(doc: IRNode) -> bytes:
+    import msgpack  # pip: msgpack (optional)
+
+    return msgpack.packb(doc.to_dict(), use_bin_type=True)
+
+
+# ============================================================
+# UI
+#    - Only runs under `streamlit run app.py`; importing app (batch CLI etc.)
+#      gives the pipeline without the page.
+# ============================================================
+def wait_for_pdf(render_queue: RenderQueue, job: RenderJob) -> bytes:
+    # Blocks this session's script run, showing where the job stands.
+    status = st.empty()
+    while not job.future.done():
+        pos = render_queue.position(job)
+        if pos:
+            status.info(f"Waiting for a free PDF slot: position {pos} in the queue ...")
+        elif job.parts_total > 1:
+            status.progress(
+                job.parts_done / job.parts_total, text=f"Rendering PDF: part {job.parts_done}/{job.parts_total} ..."
+            )
+        else:
+            status.info("Rendering PDF ...")
+        wait([job.future], timeout=0.3)
+    status.empty()
+    return job.future.result()
+
+
+def main() -> None:
+    st.set_page_config(page_title="Nirnay MD → HTML/PDF", layout="centered")
+
+    st.title("Nirnay Daily CA — Markdown to HTML + PDF (Single Column)")
+    st.caption("Upload a .md file → consistent Nirnay HTML + PDF (no MD edits required).")
+    st.caption(f"Markdown renderer: `{MARKDOWN_RENDERER.name}` · HTML parser: `{PARSER_BACKEND}`")
+    engine = get_pdf_engine() if PDF_PREWARM else None
+    if engine is not None:
+        st.sidebar.caption(f"PDF engine: {engine.label}")
+
+    uploaded = st.file_uploader(
+        "Upload Markdown file (or a .zip with the .md and its images)",
+        type=["md", "markdown", "zip"],
+    )
+
+    profiling = st.sidebar.toggle(
+        "Profile render stages",
+        help=f"Times every stage (bypasses the render cache). Records go to {PROFILE_LOG}.",
+    )
+    chunked = st.sidebar.toggle(
+        "Parallel PDF (large compilations)",
+        help="Prints the document in pieces on several browsers and stitches them. "
+        "Pieces are cut at page breaks only: a daily has one (after the Index), so it "
+        "splits in two and gains little; compilations break before every day. "
+        "Cutting every N topics parallelizes any document but changes pagination.",
+    )
+    topics_per_chunk = None
+    if chunked:
+        topics_per_chunk = st.sidebar.number_input(
+            "Also cut every N topics (0 = page breaks only; starts each group on a new page)",
+            min_value=0, value=0, step=5,
+        ) or None
+
+    if uploaded:
+        assets = None
+        if uploaded.name.lower().endswith(".zip"):
+            # Images are read from the archive on demand; nothing is extracted.
+            try:
+                md_name, md_text, assets = open_bundle(uploaded)
+            except (ValueError, zipfile.BadZipFile) as e:
+                st.error(f"Could not read the bundle: {e}")
+                st.stop()
+            base_name = Path(md_name).stem
+        else:
+            md_text = uploaded.read().decode("utf-8", errors="ignore")
+            base_name = Path(uploaded.name).stem
+
+        # Encoded once: the cache, the download and the PDF key share the bytes.
+        if profiling:
+            with profiled(f"{base_name}.html", trace_memory=True, cprofile=True) as prof:
+                full_html = md_to_full_html(md_text, title_fallback=base_name, assets=assets)
+            st.session_state["profiles"] = [prof.record()]
+            html_bytes = full_html.encode("utf-8")
+        else:
+            html_bytes = cached_md_to_html_bytes(md_text, title_fallback=base_name, assets=assets)
+            full_html = html_bytes.decode("utf-8")
+
+        st.success("Rendered HTML successfully.")
+
+        with st.expander("Preview (HTML)", expanded=False):
+            preview = get_preview_document(hashlib.sha256(html_bytes).hexdigest(), full_html)
+            titles = preview.titles
+            nav, size = st.columns([3, 1])
+            first = nav.selectbox("Jump to topic", range(len(titles)), format_func=lambda i: titles[i])
+            count = size.number_input("Topics shown", min_value=1, max_value=20, value=PREVIEW_TOPICS)
+            window = preview.window(first, count, by_reference=bool(st.get_option("server.enableStaticServing")))
+            st.components.v1.html(window, height=650, scrolling=True)
+            st.caption(f"Topics {first + 1}–{min(first + count, len(titles))} of {len(titles)}")
+
+        st.download_button(
+            "Download HTML",
+            data=html_bytes,
+            file_name=f"{base_name}_nirnay.html",
+            mime="text/html",
+        )
+
+        # Identical re-uploads go straight to download.
+        pdf_bytes = None if profiling else get_render_cache().get(pdf_cache_key(html_bytes, topics_per_chunk))
+
+        if pdf_bytes is None and st.button("Generate PDF"):
+            try:
+                with st.spinner("Preparing PDF engine (Chromium) ..."):
+                    if engine is not None:
+                        engine.wait()
+                    ensure_playwright_chromium()
+
+                render_queue = get_render_queue()
+                if profiling:
+                    with profiled(f"{base_name}.pdf", trace_memory=True) as prof:
+                        job = render_queue.submit(
+                            full_html, chunked=chunked, topics_per_chunk=topics_per_chunk, use_cache=False
+                        )
+                        pdf_bytes = wait_for_pdf(render_queue, job)
+                    st.session_state.setdefault("profiles", []).append(prof.record())
+                else:
+                    job = render_queue.submit(full_html, chunked=chunked, topics_per_chunk=topics_per_chunk)
+                    pdf_bytes = wait_for_pdf(render_queue, job)
+            except TimeoutError:
+                st.error(f"PDF generation timed out after {PDF_JOB_TIMEOUT_S:.0f} s. Please try again.")
+            except subprocess.CalledProcessError as e:
+                st.error(
+                    "Playwright could not install Chromium in this environment.\n\n"
+                    "Make sure your Streamlit Cloud repo includes:\n"
+                    "1) requirements.txt with 'playwright'\n"
+                    "2) packages.txt with required system libraries\n\n"
+                    f"Install error:\n{e}"
+                )
+            except Exception as e:
+                st.error(
+                    "PDF generation failed.\n\n"
+                    "If running locally:\n"
+                    "python -m playwright install chromium\n\n"
+                    f"Error: {e}"
+                )
+
+        if pdf_bytes is not None:
             st.download_button(
                 "Download PDF",
                 data=pdf_bytes,
@@ -736,18 +3519,20 @@ if uploaded:
                 mime="application/pdf",
             )
             st.success("PDF ready.")
-        except subprocess.CalledProcessError as e:
-            st.error(
-                "Playwright could not install Chromium in this environment.\n\n"
-                "Make sure your Streamlit Cloud repo includes:\n"
-                "1) requirements.txt with 'playwright'\n"
-                "2) packages.txt with required system libraries\n\n"
-                f"Install error:\n{e}"
-            )
-        except Exception as e:
-            st.error(
-                "PDF generation failed.\n\n"
-                "If running locally:\n"
-                "python -m playwright install chromium\n\n"
-                f"Error: {e}"
-            )
+
+        if profiling and st.session_state.get("profiles"):
+            with st.expander("Render profile", expanded=True):
+                for rec in st.session_state["profiles"]:
+                    st.markdown(f"**{rec['doc']}** — {rec['wall_ms']:.1f} ms")
+                    st.dataframe(rec["stages"], use_container_width=True)
+                    if rec["cprofile"]:
+                        st.caption(f"cProfile dump: {rec['cprofile']}")
+
+
+# Kick off the warm-up as soon as the app is served (not for the CLIs).
+if PDF_PREWARM and st.runtime.exists():
+    get_pdf_engine()
+
+
+if __name__ == "__main__":
+    main()
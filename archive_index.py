@@ -0,0 +1,172 @@
+"""
+Searchable section index over the archive of rendered documents.
+
+    python archive_index.py build archive/                 # add new / changed files
+    python archive_index.py search "repo rate"             # anywhere
+    python archive_index.py search "tiger reserve" --kind prelims --days 90
+    python archive_index.py search "federalism" --kind mains recall --limit 20
+
+Every conversion yields an outline (app.document_outline: topic → section
+kind → text). Outlines are stored in SQLite with an FTS5 table over the
+section text, so queries never touch markdown or HTML again. Documents are
+keyed by path and content key; rebuilding skips anything unchanged and
+takes rendered pages from the render cache. batch.py --index DB feeds the
+same index while it converts.
+"""
+import sys
+import json
+import time
+import sqlite3
+import argparse
+from datetime import date, timedelta
+from pathlib import Path
+
+import app
+from batch import collect_sources
+
+DEFAULT_DB = app.RENDER_CACHE_DIR / "archive-index.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    day TEXT,
+    title TEXT,
+    key TEXT NOT NULL,
+    outline TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS documents_day ON documents(day);
+CREATE VIRTUAL TABLE IF NOT EXISTS sections USING fts5(
+    topic, heading, text,
+    kind UNINDEXED, doc_id UNINDEXED, day UNINDEXED,
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+
+
+# ============================================================
+# Index
+# ============================================================
+def open_index(db_path: Path) -> sqlite3.Connection:
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.executescript(SCHEMA)
+    except sqlite3.OperationalError as e:
+        conn.close()
+        raise RuntimeError(f"this SQLite build has no FTS5 ({e})") from e
+    return conn
+
+
+def indexed_key(conn: sqlite3.Connection, path: Path) -> str | None:
+    row = conn.execute("SELECT key FROM documents WHERE path = ?", (str(path),)).fetchone()
+    return row[0] if row else None
+
+
+def add_record(conn: sqlite3.Connection, path: Path, key: str, outline: dict) -> int:
+    # Replaces whatever was indexed for this path; returns the section count.
+    day = app.daily_date(path)
+    day = day.isoformat() if day else None
+    with conn:
+        old = conn.execute("SELECT id FROM documents WHERE path = ?", (str(path),)).fetchone()
+        if old:
+            conn.execute("DELETE FROM sections WHERE doc_id = ?", (old[0],))
+            conn.execute("DELETE FROM documents WHERE id = ?", (old[0],))
+        doc_id = conn.execute(
+            "INSERT INTO documents (path, day, title, key, outline) VALUES (?, ?, ?, ?, ?)",
+            (str(path), day, outline["title"], key, json.dumps(outline, separators=(",", ":"))),
+        ).lastrowid
+        rows = [
+            (topic["title"], sec["heading"], sec["text"], sec["kind"], doc_id, day)
+            for topic in outline["topics"]
+            for sec in topic["sections"]
+        ]
+        conn.executemany("INSERT INTO sections (topic, heading, text, kind, doc_id, day) VALUES (?, ?, ?, ?, ?, ?)", rows)
+    return len(rows)
+
+
+def search(
+    conn: sqlite3.Connection,
+    query: str,
+    kinds: list[str] | None = None,
+    since: date | None = None,
+    limit: int = 50,
+) -> list[dict]:
+    sql = (
+        "SELECT d.path, d.day, s.topic, s.kind, s.heading, snippet(sections, 2, '[', ']', ' … ', 16) "
+        "FROM sections s JOIN documents d ON d.id = s.doc_id WHERE sections MATCH ?"
+    )
+    params: list = [query]
+    if kinds:
+        sql += f" AND s.kind IN ({', '.join('?' * len(kinds))})"
+        params += kinds
+    if since is not None:
+        sql += " AND s.day >= ?"
+        params.append(since.isoformat())
+    sql += " ORDER BY s.day DESC, rank LIMIT ?"
+    params.append(limit)
+    keys = ("path", "day", "topic", "kind", "heading", "snippet")
+    return [dict(zip(keys, row)) for row in conn.execute(sql, params)]
+
+
+# ============================================================
+# Commands
+# ============================================================
+def build(args: argparse.Namespace) -> int:
+    sources = app.select_dailies(collect_sources(args.inputs))
+    conn = open_index(Path(args.db))
+    added = skipped = sections = 0
+    t0 = time.perf_counter()
+    for _, src in sources:
+        md_bytes = src.read_bytes()
+        key = app.html_cache_key(md_bytes.decode("utf-8", errors="ignore"), src.stem, str(src))
+        if not args.force and indexed_key(conn, src) == key:
+            skipped += 1
+            continue
+        page = app.cached_md_to_html_bytes(
+            md_bytes.decode("utf-8", errors="ignore"), title_fallback=src.stem, md_filename=str(src)
+        )
+        sections += add_record(conn, src, key, app.document_outline(page.decode("utf-8")))
+        added += 1
+    conn.close()
+    print(f"{added} indexed ({sections} sections), {skipped} unchanged in {time.perf_counter() - t0:.1f} s → {args.db}")
+    return 0
+
+
+def run_search(args: argparse.Namespace) -> int:
+    conn = open_index(Path(args.db))
+    since = date.today() - timedelta(days=args.days) if args.days else None
+    t0 = time.perf_counter()
+    try:
+        hits = search(conn, args.query, args.kind, since, args.limit)
+    except sqlite3.OperationalError as e:
+        print(f"bad query: {e}", file=sys.stderr)
+        return 2
+    elapsed = (time.perf_counter() - t0) * 1000
+    for hit in hits:
+        print(f"{hit['day'] or '----------'}  {hit['kind']:<10} {hit['topic']}  ({Path(hit['path']).name})")
+        print(f"    {hit['snippet']}")
+    print(f"{len(hits)} hits in {elapsed:.1f} ms")
+    return 0
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    ap = argparse.ArgumentParser(description="Index rendered Nirnay documents by topic and section, and search them.")
+    ap.add_argument("--db", default=str(DEFAULT_DB), help=f"index file (default: {DEFAULT_DB})")
+    sub = ap.add_subparsers(dest="command", required=True)
+
+    b = sub.add_parser("build", help="index new or changed markdown files")
+    b.add_argument("inputs", nargs="+", help="directories, files or glob patterns")
+    b.add_argument("--force", action="store_true", help="re-index unchanged files too")
+
+    s = sub.add_parser("search", help="full-text search over section text (FTS5 query syntax)")
+    s.add_argument("query")
+    s.add_argument("--kind", nargs="+", help="section kinds: prelims mains recall context analysis ... body")
+    s.add_argument("--days", type=int, help="only documents dated within the last N days")
+    s.add_argument("--limit", type=int, default=50)
+    return ap.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    sys.exit(build(args) if args.command == "build" else run_search(args))
@@ -0,0 +1,272 @@
+"""
+Headless batch conversion: Markdown files → Nirnay HTML (+ PDF).
+
+    python batch.py archive/                 # every .md under archive/
+    python batch.py "archive/2024-*.md" --out build/ --jobs 8 --browsers 3
+    python batch.py archive/ --no-pdf --force
+    python batch.py archive/ --index archive.sqlite   # also feed the section index
+    python batch.py archive/ --no-pdf --ir            # also write <name>.ir.json
+
+The HTML stage runs across a process pool, the PDF stage across one shared
+warm browser pool. Outputs whose source, CSS and pipeline version are
+unchanged since the last run are skipped (tracked in a manifest in each
+output folder).
+"""
+import os
+import sys
+import glob
+import json
+import asyncio
+import time
+import argparse
+import subprocess
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import app
+
+MANIFEST_NAME = ".nirnay-manifest.json"
+MD_SUFFIXES = (".md", ".markdown")
+
+
+# ============================================================
+# Inputs / outputs
+# ============================================================
+def collect_sources(specs: list[str]) -> list[Path]:
+    found: dict[Path, None] = {}
+    for spec in specs:
+        p = Path(spec)
+        if p.is_dir():
+            matches = [f for f in sorted(p.rglob("*")) if f.suffix.lower() in MD_SUFFIXES]
+        elif p.is_file():
+            matches = [p]
+        else:
+            matches = [Path(m) for m in sorted(glob.glob(spec, recursive=True))]
+        for m in matches:
+            if m.is_file():
+                found[m.resolve()] = None
+    return list(found)
+
+
+def output_base(src: Path, root: Path, out_dir: Path | None) -> Path:
+    # <out>/<path relative to the common input root>/<stem>_nirnay
+    folder = src.parent if out_dir is None else out_dir / src.parent.relative_to(root)
+    return folder / f"{src.stem}_nirnay"
+
+
+def source_key(src: Path, md_bytes: bytes) -> str:
+    # Changes with the markdown and with any local image it refers to.
+    return app.html_cache_key(md_bytes.decode("utf-8", errors="ignore"), src.stem, str(src))
+
+
+def load_manifest(folder: Path) -> dict:
+    try:
+        return json.loads((folder / MANIFEST_NAME).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifests(manifests: dict[Path, dict]) -> None:
+    for folder, data in manifests.items():
+        folder.mkdir(parents=True, exist_ok=True)
+        (folder / MANIFEST_NAME).write_text(json.dumps(data, indent=1, sort_keys=True), encoding="utf-8")
+
+
+# ============================================================
+# Stage workers
+# ============================================================
+def write_html(md_text: str, src: str, f, ir: bool):
+    # Streamed straight into the file; the page is never held as one string.
+    # With ir, the IR is read off the same tree and returned.
+    doc_title, soup = app.render_document(md_text, title_fallback=Path(src).stem, md_filename=src)
+    app.write_chunks(app.iter_document(doc_title, app.iter_fragment_html(soup)), f)
+    return app.document_ir(doc_title, soup) if ir else None
+
+
+def render_html_job(
+    src: str, html_path: str, profile: bool = False, outline: bool = False, ir: bool = False
+) -> tuple[float, dict | None]:
+    # Runs in a worker process; optionally returns the document outline.
+    t0 = time.perf_counter()
+    md_text = Path(src).read_text(encoding="utf-8", errors="ignore")
+    Path(html_path).parent.mkdir(parents=True, exist_ok=True)
+    with open(html_path, "w", encoding="utf-8") as f:
+        if profile:
+            with app.profiled(Path(src).name, cprofile=True):
+                doc_ir = write_html(md_text, src, f, ir)
+        else:
+            doc_ir = write_html(md_text, src, f, ir)
+    if doc_ir is not None:
+        Path(html_path).with_suffix(".ir.json").write_text(app.ir_to_json(doc_ir), encoding="utf-8")
+    record = app.document_outline(Path(html_path).read_text(encoding="utf-8")) if outline else None
+    return time.perf_counter() - t0, record
+
+
+def prefetch_images(html_paths: list[str]) -> None:
+    # One concurrent fetch for every remote image of the run, before the
+    # browsers start (they are then answered from the cache).
+    if not app.REMOTE_IMAGES:
+        return
+    urls = [u for hp in html_paths for u in app.remote_image_urls(Path(hp).read_text(encoding="utf-8"))]
+    if urls:
+        asyncio.run(app.get_remote_images().prefetch(list(dict.fromkeys(urls))))
+
+
+def timed_print_pdf(browser, html_path: str, pdf_path: str) -> float:
+    # Runs on a browser pool thread.
+    t0 = time.perf_counter()
+    full_html = Path(html_path).read_text(encoding="utf-8")
+    Path(pdf_path).write_bytes(app.print_pdf(browser, full_html))
+    return time.perf_counter() - t0
+
+
+# ============================================================
+# Reporting
+# ============================================================
+def percentile(values: list[float], q: float) -> float:
+    # Nearest-rank percentile; fine for per-run summaries.
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered) + 0.5) - 1))
+    return ordered[idx]
+
+
+def stage_summary(name: str, durations: list[float], wall: float) -> str:
+    if not durations:
+        return f"{name:<5} nothing to do"
+    rate = len(durations) / wall if wall > 0 else float("inf")
+    return (
+        f"{name:<5} {len(durations):>5} files  {rate:8.2f} files/s  "
+        f"p50 {percentile(durations, 50) * 1000:8.1f} ms  p95 {percentile(durations, 95) * 1000:8.1f} ms"
+    )
+
+
+# ============================================================
+# Main
+# ============================================================
+def run(args: argparse.Namespace) -> int:
+    sources = collect_sources(args.inputs)
+    if not sources:
+        print("No markdown files found.", file=sys.stderr)
+        return 1
+
+    root = Path(os.path.commonpath([str(s.parent) for s in sources]))
+    out_dir = Path(args.out).resolve() if args.out else None
+
+    manifests: dict[Path, dict] = {}
+    html_todo, pdf_todo, html_done = [], [], []
+    skipped = 0
+
+    for src in sources:
+        base = output_base(src, root, out_dir)
+        html_path, pdf_path = base.with_suffix(".html"), base.with_suffix(".pdf")
+        manifest = manifests.setdefault(base.parent, load_manifest(base.parent))
+        key = source_key(src, src.read_bytes())
+        entry = manifest.get(src.name, {})
+
+        html_fresh = not args.force and entry.get("html") == key and html_path.exists()
+        if args.ir and not html_path.with_suffix(".ir.json").exists():
+            html_fresh = False
+        pdf_fresh = not args.force and entry.get("pdf") == key and pdf_path.exists()
+
+        if not html_fresh:
+            html_todo.append((src, html_path, key, manifest))
+        else:
+            html_done.append((src, html_path, key))
+        if not args.no_pdf and not pdf_fresh:
+            pdf_todo.append((src, html_path, pdf_path, key, manifest))
+        if html_fresh and (args.no_pdf or pdf_fresh):
+            skipped += 1
+
+    failures = 0
+    index = None
+    if args.index:
+        import archive_index
+
+        index = archive_index.open_index(Path(args.index))
+        # Up-to-date HTML isn't rendered again, but may be missing from (or
+        # stale in) this index; its outline comes from the file on disk.
+        for src, hp, key in html_done:
+            if archive_index.indexed_key(index, src) != key:
+                archive_index.add_record(index, src, key, app.document_outline(hp.read_text(encoding="utf-8")))
+
+    # ---- HTML stage (process pool) ----
+    html_times: list[float] = []
+    html_failed: set[Path] = set()
+    t0 = time.perf_counter()
+    if html_todo:
+        with ProcessPoolExecutor(max_workers=args.jobs) as ex:
+            futs = {
+                ex.submit(render_html_job, str(src), str(hp), args.profile, index is not None, args.ir): (src, key, m)
+                for src, hp, key, m in html_todo
+            }
+            for fut in as_completed(futs):
+                src, key, manifest = futs[fut]
+                try:
+                    seconds, record = fut.result()
+                    html_times.append(seconds)
+                    manifest.setdefault(src.name, {})["html"] = key
+                    if index is not None:
+                        archive_index.add_record(index, src, key, record)
+                except Exception as e:
+                    failures += 1
+                    html_failed.add(src)
+                    print(f"[html] {src}: {e}", file=sys.stderr)
+    html_wall = time.perf_counter() - t0
+
+    # ---- PDF stage (shared browser pool) ----
+    pdf_times: list[float] = []
+    t0 = time.perf_counter()
+    pdf_todo = [job for job in pdf_todo if job[0] not in html_failed]
+    if pdf_todo:
+        try:
+            app.ensure_playwright_chromium()
+        except subprocess.CalledProcessError as e:
+            print(f"[pdf] could not install Chromium: {e}", file=sys.stderr)
+            failures += len(pdf_todo)
+            pdf_todo = []
+    if pdf_todo:
+        prefetch_images([str(hp) for _, hp, _, _, _ in pdf_todo])
+        pool = app.BrowserPool(size=args.browsers)
+        try:
+            futs = {pool.submit(timed_print_pdf, str(hp), str(pp)): (src, key, m) for src, hp, pp, key, m in pdf_todo}
+            for fut in as_completed(futs):
+                src, key, manifest = futs[fut]
+                try:
+                    pdf_times.append(fut.result())
+                    manifest.setdefault(src.name, {})["pdf"] = key
+                except Exception as e:
+                    failures += 1
+                    print(f"[pdf] {src}: {e}", file=sys.stderr)
+        finally:
+            pool.shutdown()
+    pdf_wall = time.perf_counter() - t0
+
+    save_manifests(manifests)
+    if index is not None:
+        index.close()
+
+    print(stage_summary("HTML", html_times, html_wall))
+    if not args.no_pdf:
+        print(stage_summary("PDF", pdf_times, pdf_wall))
+    print(f"{len(sources)} sources, {skipped} up to date, {failures} failed")
+    return 1 if failures else 0
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    ap = argparse.ArgumentParser(description="Convert Nirnay markdown files to HTML/PDF in bulk.")
+    ap.add_argument("inputs", nargs="+", help="directories, files or glob patterns")
+    ap.add_argument("--out", help="output folder (default: next to each source)")
+    ap.add_argument("--jobs", type=int, default=None, help="HTML worker processes (default: CPU count)")
+    ap.add_argument("--browsers", type=int, default=app.PDF_POOL_SIZE, help="concurrent Chromium instances")
+    ap.add_argument("--no-pdf", action="store_true", help="HTML only")
+    ap.add_argument("--profile", action="store_true", help=f"append per-stage HTML timings to {app.PROFILE_LOG}")
+    ap.add_argument("--force", action="store_true", help="re-render even if outputs are up to date")
+    ap.add_argument("--index", help="also add each converted document to this section index (see archive_index.py)")
+    ap.add_argument("--ir", action="store_true", help="also write the typed document tree as <name>.ir.json")
+    return ap.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(run(parse_args()))
@@ -0,0 +1,600 @@
+"""
+Reproducible render benchmark on synthetic Nirnay-style documents.
+
+    python bench.py                               # 1 … 500 topics, HTML + PDF
+    python bench.py --sizes 1 50 150 --no-pdf --repeat 5
+    python bench.py --out after.json --compare before.json
+    python bench.py --parity --corpus archive/       # parser backends and incremental render agree?
+    python bench.py --rank-markdown --corpus archive/  # fastest markdown library
+    python bench.py --check-cleanup --repeat 2000      # streaming cleaner == reference
+    python bench.py --check-remote                     # image prefetcher vs a local stub host
+    python bench.py --check-scaling                    # transforms stay linear in document size
+    python bench.py --check-reruns                     # PDF stages still profiled after a Streamlit rerun
+
+Documents are generated deterministically (fixed seed) in the real shape:
+banner H1, an Index, topic H2s each carrying the standard sections that
+classify_section recognizes, pipe tables and local images. HTML and PDF
+stages are timed separately; PDF timings use a warm browser (launch is
+excluded and reported once). Runs fully offline against the locally
+installed Chromium.
+"""
+import gc
+import re
+import sys
+import json
+import zlib
+import time
+import random
+import runpy
+import struct
+import asyncio
+import hashlib
+import threading
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import app
+
+DEFAULT_SIZES = [1, 10, 50, 150, 500]
+WORDS = (
+    "policy reserve bank inflation monsoon tribunal governance fiscal ecology treaty summit "
+    "judiciary parliament scheme mission index report biodiversity satellite corridor reform "
+    "constitution federal tariff subsidy census literacy ordinance amendment petition"
+).split()
+
+
+# ============================================================
+# Synthetic documents
+# ============================================================
+def write_png(path: Path, width: int = 480, height: int = 270) -> None:
+    # Plain RGB gradient; big enough that base64 inlining shows up in timings.
+    raw = b"".join(
+        b"\x00" + b"".join(bytes((x * 255 // width, y * 255 // height, 128)) for x in range(width))
+        for y in range(height)
+    )
+
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    path.write_bytes(b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", ihdr) + chunk(b"IDAT", zlib.compress(raw, 6)) + chunk(b"IEND", b""))
+
+
+def sentence(rng: random.Random, n: int = 14) -> str:
+    words = [rng.choice(WORDS) for _ in range(n)]
+    words[rng.randrange(n)] = f"**{words[0]}**"
+    return " ".join(words).capitalize() + "."
+
+
+def pipe_table(rng: random.Random, rows: int, cols: int = 2) -> str:
+    header = ["Category", "Fact / Detail", "Source"][:cols]
+    lines = ["| " + " | ".join(header) + " |", "|" + "---|" * cols]
+    for _ in range(rows):
+        lines.append("| " + " | ".join(sentence(rng, 4 if c == 0 else 10) for c in range(cols)) + " |")
+    return "\n".join(lines)
+
+
+def synth_markdown(topics: int, seed: int = 0) -> str:
+    rng = random.Random(seed * 100003 + topics)
+    titles = [f"{i}. {' '.join(rng.choice(WORDS) for _ in range(5)).title()}" for i in range(1, topics + 1)]
+
+    out = ["# Nirnay Daily Current Affairs {#top}", "", "## Index", ""]
+    out += [f"- {t}" for t in titles]
+    out.append("")
+
+    for t in titles:
+        out += [
+            f"## {t} {{#{rng.randrange(10**6)}}}", "",
+            "### Syllabus Mapping", "", f"GS{rng.randint(1, 4)}: {sentence(rng, 6)}", "",
+            "### Why in News", "", sentence(rng), "",
+            "### Key Analysis", "",
+            *[f"- {sentence(rng)}" for _ in range(rng.randint(3, 6))], "",
+            pipe_table(rng, rng.randint(3, 8), cols=rng.choice((2, 2, 3))), "",
+            f"![figure](img/fig{rng.randint(1, 3)}.png)", "",
+            "### Beyond the News", "", sentence(rng, 30), "",
+            "### Way Forward", "", *[f"1. {sentence(rng)}" for _ in range(3)], "",
+            "### Prelims Pointers", "", pipe_table(rng, rng.randint(4, 12)), "",
+            "### Mains Practice Question", "", sentence(rng, 25), "",
+            "### Recall", "", sentence(rng), "",
+            "---", "",
+        ]
+    return "\n".join(out)
+
+
+def build_corpus(folder: Path, sizes: list[int], seed: int) -> dict[int, Path]:
+    (folder / "img").mkdir(parents=True, exist_ok=True)
+    for i in (1, 2, 3):
+        write_png(folder / "img" / f"fig{i}.png", 240 * i, 135 * i)
+    docs = {}
+    for n in sizes:
+        p = folder / f"synthetic_{n:04d}.md"
+        p.write_text(synth_markdown(n, seed), encoding="utf-8")
+        docs[n] = p
+    return docs
+
+
+# ============================================================
+# Timing
+# ============================================================
+def time_calls(fn, repeat: int) -> list[float]:
+    out = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        out.append(time.perf_counter() - t0)
+    return out
+
+
+def summarize(samples: list[float]) -> dict:
+    return {
+        "min_ms": round(min(samples) * 1000, 3),
+        "median_ms": round(statistics.median(samples) * 1000, 3),
+        "max_ms": round(max(samples) * 1000, 3),
+        "samples_ms": [round(s * 1000, 3) for s in samples],
+    }
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args: argparse.Namespace) -> dict:
+    result = {
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "css_version": app.CSS_VERSION,
+        "pipeline_version": app.PIPELINE_VERSION,
+        "seed": args.seed,
+        "repeat": args.repeat,
+        "results": [],
+    }
+
+    pool = None
+    if not args.no_pdf:
+        pool = app.BrowserPool(size=1, warm=False)
+        t0 = time.perf_counter()
+        app.html_to_pdf_bytes("<!doctype html><p>warm-up</p>", pool)
+        result["pdf_cold_start_ms"] = round((time.perf_counter() - t0) * 1000, 3)
+
+    try:
+        with tempfile.TemporaryDirectory() as td:
+            docs = build_corpus(Path(td), args.sizes, args.seed)
+            for n, path in docs.items():
+                md_text = path.read_text(encoding="utf-8")
+                html_fn = lambda: app.md_to_full_html(md_text, title_fallback=path.stem, md_filename=str(path))
+                full_html = html_fn()  # warm-up + output for the PDF stage
+
+                row = {
+                    "topics": n,
+                    "md_bytes": len(md_text.encode("utf-8")),
+                    "html_bytes": len(full_html.encode("utf-8")),
+                    "html": summarize(time_calls(html_fn, args.repeat)),
+                }
+                line = f"{n:>4} topics  HTML {row['html']['median_ms']:9.1f} ms"
+
+                if pool is not None:
+                    pdf_bytes = app.html_to_pdf_bytes(full_html, pool)
+                    row["pdf_bytes"] = len(pdf_bytes)
+                    row["pdf"] = summarize(time_calls(lambda: app.html_to_pdf_bytes(full_html, pool), args.repeat))
+                    line += f"  PDF {row['pdf']['median_ms']:9.1f} ms"
+
+                result["results"].append(row)
+                print(line, flush=True)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    return result
+
+
+# ============================================================
+# Parser parity
+# ============================================================
+# Raw HTML the synthetic corpus never produces; lxml and html.parser place
+# some of it differently (e.g. a leading comment outside <body>).
+RAW_HTML_DOCS = {
+    "leading-comment": "<!-- note: draft -->\n\n# Daily {#d}\n\n## Index\n\n- One\n\n## 1. One\n\ntext\n",
+    "comments-only": "<!-- nothing here yet -->\n",
+    "comment-between-topics": "# Daily\n\n## 1. One\n\nA.\n\n<!-- editor: verify figures -->\n\n## 2. Two\n\nB.\n",
+    "trailing-comment": "# Daily\n\n## 1. One\n\n### Key Analysis\n\n- point\n\n<!-- end -->\n",
+    "leading-style": "<style>.x { color: red }</style>\n\n# Daily\n\n## 1. One\n\ntext\n",
+    "raw-blocks": (
+        "# Daily\n\n## 1. One\n\n<div class=\"note\">\n<p>Raw <b>block</b> &amp; entity</p>\n</div>\n\n"
+        "<details><summary>More</summary>\n\nHidden text\n\n</details>\n\n"
+        "Inline <span title=\"t\">span</span> and <br> break.\n\n"
+        "<table><tr><td>raw</td><td>table</td></tr></table>\n"
+    ),
+}
+
+# Markdown whose raw text splits differently from the cleaned text the
+# renderer sees; the incremental render must still match the whole render.
+SPLIT_DOCS = {
+    "blank-headings-after-table": (
+        "| h | i |\n|---|---|\n| <b>a</b>  | ![g](x.png) |\n\n## \n\n## {#x}\n\n"
+        "## Contents\n\n## Recap\n\n## Alpha\n\n| a |\n|---|\n| x |"
+    ),
+}
+
+
+def normalize_html(html: str) -> str:
+    return re.sub(r">\s+<", "><", html).strip()
+
+
+def parity(args: argparse.Namespace) -> int:
+    # Every installed parser backend must emit the same HTML as html.parser,
+    # and the per-topic incremental render the same HTML as the whole render.
+    backends = [b for b in app.PARSER_PREFERENCE if app.pick_parser(b) == b]
+    if len(backends) < 2:
+        print(f"only {backends} installed; comparing the incremental render only")
+
+    saved = app.PARSER_BACKEND
+    counts = {"identical": 0, "equivalent": 0, "different": 0}
+    try:
+        with tempfile.TemporaryDirectory() as td:
+            docs = list(build_corpus(Path(td), args.sizes, args.seed).values())
+            for prefix, extra in (("raw", RAW_HTML_DOCS), ("split", SPLIT_DOCS)):
+                for name, md_text in extra.items():
+                    docs.append(Path(td) / f"{prefix}-{name}.md")
+                    docs[-1].write_text(md_text, encoding="utf-8")
+            docs += [p for spec in args.corpus for p in sorted(Path(spec).rglob("*.md") if Path(spec).is_dir() else [Path(spec)])]
+            for path in docs:
+                md_text = path.read_text(encoding="utf-8", errors="ignore")
+                outputs = {}
+                for backend in backends:
+                    app.PARSER_BACKEND = backend
+                    outputs[backend] = app.md_to_full_html(md_text, title_fallback=path.stem, md_filename=str(path))
+                ref = outputs["html.parser"]
+                app.PARSER_BACKEND = "html.parser"
+                outputs["incremental"] = app.md_to_full_html_incremental(
+                    md_text, title_fallback=path.stem, md_filename=str(path), cache=app.RenderCache(None)
+                )
+                for backend, html in outputs.items():
+                    if backend == "html.parser":
+                        continue
+                    if html == ref:
+                        verdict = "identical"
+                    elif normalize_html(html) == normalize_html(ref):
+                        verdict = "equivalent"
+                    else:
+                        verdict = "different"
+                    counts[verdict] += 1
+                    if verdict != "identical":
+                        print(f"{verdict:<10} {backend:<11} {path.name}")
+    finally:
+        app.PARSER_BACKEND = saved
+
+    print(", ".join(f"{n} {k}" for k, n in counts.items()))
+    return 1 if counts["different"] else 0
+
+
+# ============================================================
+# Markdown backend ranking
+# ============================================================
+def rank_markdown(args: argparse.Namespace) -> int:
+    with tempfile.TemporaryDirectory() as td:
+        docs = list(build_corpus(Path(td), args.sizes, args.seed).values())
+        docs += [p for spec in args.corpus for p in sorted(Path(spec).rglob("*.md") if Path(spec).is_dir() else [Path(spec)])]
+        samples = [app.cleanup_markdown(p.read_text(encoding="utf-8", errors="ignore")) for p in docs]
+
+    ranking = app.rank_markdown_backends(samples, repeat=args.repeat)
+    for name, seconds in ranking:
+        print(f"{name:<10} {seconds * 1000:10.1f} ms")
+    if ranking:
+        print(f"fastest: NIRNAY_MARKDOWN={ranking[0][0]} (currently {app.MARKDOWN_RENDERER.name})")
+    return 0
+
+
+# ============================================================
+# cleanup_markdown equivalence
+# ============================================================
+def reference_cleanup_markdown(md_text: str) -> str:
+    # The original whole-document regex version, kept as the oracle.
+    md_text = re.sub(r"(?m)^\s*#{1,6}\s*$\n?", "", md_text)
+    md_text = re.sub(r"(?m)^(#{1,6}\s+.*?)(\s*\{[^{}]*\})\s*$", r"\1", md_text)
+    md_text = re.sub(r"\\([\\`*_{}\[\]()#+\-.!|>~])", r"\1", md_text)
+    lines = md_text.splitlines()
+    out = []
+    for i, line in enumerate(lines):
+        out.append(line)
+        if re.match(r"^\s*\|.*\|\s*$", line):
+            if i + 1 < len(lines):
+                nxt = lines[i + 1]
+                if nxt.strip() and re.match(r"^\s*#{1,6}\s+\S", nxt):
+                    out.append("")
+    return "\n".join(out)
+
+
+CLEANUP_FRAGMENTS = (
+    "", " ", "\t", "#", "##", "  ### ", "#######", "## Title", "## Title {#id}", "### T {.c} ", "# A {x} {y}",
+    "## {", "}", "{", "{#a}", "x {", "b}", "## Topic ", "| a | b |", " |x| ", "|", "para", "\\*", "\\\\#", "\\_x\\]",
+    "\r", "\x0b", "\x0c", "\x1c", "\u2028", "\x85", "\u00a0", "- item", "```", "    code {x}",
+)
+
+
+def fuzz_markdown(rng: random.Random) -> str:
+    # Random lines glued from fragments that stress the cleanup rules.
+    lines = []
+    for _ in range(rng.randint(0, 14)):
+        lines.append("".join(rng.choice(CLEANUP_FRAGMENTS) for _ in range(rng.randint(0, 3))))
+    text = "\n".join(lines)
+    return text + rng.choice(("", "\n", "\n\n", "\r\n"))
+
+
+def check_cleanup(args: argparse.Namespace) -> int:
+    rng = random.Random(args.seed)
+    docs = [fuzz_markdown(rng) for _ in range(args.repeat * 100)]
+    with tempfile.TemporaryDirectory() as td:
+        paths = list(build_corpus(Path(td), args.sizes, args.seed).values())
+        paths += [p for spec in args.corpus for p in sorted(Path(spec).rglob("*.md") if Path(spec).is_dir() else [Path(spec)])]
+        docs += [p.read_text(encoding="utf-8", errors="ignore") for p in paths]
+
+    failures = 0
+    for doc in docs:
+        if app.cleanup_markdown(doc) != reference_cleanup_markdown(doc):
+            failures += 1
+            if failures <= 5:
+                print(f"mismatch: {doc!r}")
+    print(f"{len(docs) - failures}/{len(docs)} documents identical")
+
+    # A heading whose "{" never closes makes the look-ahead run to EOF.
+    unclosed = "## Budget {draft\n" + "line of text\n" * 40000
+    if app.cleanup_markdown(unclosed) != reference_cleanup_markdown(unclosed):
+        failures += 1
+        print("mismatch: unclosed heading attribute")
+    new = min(time_calls(lambda: app.cleanup_markdown(unclosed), 3))
+    old = min(time_calls(lambda: reference_cleanup_markdown(unclosed), 3))
+    print(f"unclosed '{{' + 40k lines: streaming {new * 1000:.1f} ms, reference {old * 1000:.1f} ms")
+
+    big = "\n".join(docs[-len(paths):]) * 4 if paths else ""
+    if big:
+        new = min(time_calls(lambda: app.cleanup_markdown(big), 3))
+        old = min(time_calls(lambda: reference_cleanup_markdown(big), 3))
+        print(f"{len(big) / 1e6:.1f} MB: streaming {new * 1000:.1f} ms, reference {old * 1000:.1f} ms")
+    return 1 if failures else 0
+
+
+SCALING_SIZES = [50, 150, 500, 1000]
+SCALING_TOLERANCE = 2.0  # allowed growth of per-topic transform time, smallest → largest
+
+
+def tree_errors(soup) -> int:
+    # Parent / sibling / element links that disagree with .contents order.
+    errors = 0
+    order = []
+
+    def visit(tag) -> None:
+        nonlocal errors
+        prev = None
+        for child in tag.contents:
+            order.append(child)
+            errors += child.parent is not tag
+            errors += child.previous_sibling is not prev
+            if prev is not None:
+                errors += prev.next_sibling is not child
+            prev = child
+            if hasattr(child, "contents"):
+                visit(child)
+        if prev is not None:
+            errors += prev.next_sibling is not None
+
+    visit(soup)
+    for a, b in zip(order, order[1:]):
+        errors += a.next_element is not b or b.previous_element is not a
+    return errors
+
+
+def check_scaling(args: argparse.Namespace) -> int:
+    failures = 0
+    per_topic = {}
+    for topics in SCALING_SIZES:
+        body_html = app.render_markdown(app.cleanup_markdown(synth_markdown(topics, args.seed)))
+        samples = []
+        for _ in range(max(1, min(args.repeat, 3))):
+            soup = app.parse_html(body_html)
+            # Full collections scan the whole heap (the tree included); keep
+            # them out so the numbers show the transforms' own growth.
+            gc.collect()
+            gc.disable()
+            try:
+                t0 = time.perf_counter()
+                app.apply_transforms(soup, app.document_transforms(None))
+                samples.append(time.perf_counter() - t0)
+            finally:
+                gc.enable()
+        bad_links = tree_errors(soup)
+        failures += bad_links > 0
+        per_topic[topics] = min(samples) * 1000 / topics
+        print(f"{topics:>5} topics  transforms {min(samples) * 1000:8.1f} ms  {per_topic[topics]:6.2f} ms/topic"
+              + (f"  {bad_links} broken tree links" if bad_links else ""))
+    growth = per_topic[SCALING_SIZES[-1]] / per_topic[SCALING_SIZES[0]]
+    linear = growth <= SCALING_TOLERANCE
+    print(f"per-topic cost x{growth:.2f} from {SCALING_SIZES[0]} to {SCALING_SIZES[-1]} topics "
+          f"({'linear' if linear else 'super-linear'})")
+    return 0 if linear and not failures else 1
+
+
+REMOTE_DELAY_S = 0.3
+
+
+class StubImageHost(BaseHTTPRequestHandler):
+    # /fresh/N.png (max-age), /stale/N.png (max-age=0, ETag), /slow.png (late headers),
+    # /trickle.png (one byte at a time), /empty.png (200, no body), anything else 404
+    png = b""
+    requests: list[tuple[str, int]] = []
+
+    def do_GET(self) -> None:
+        etag = '"' + hashlib.sha256(self.png).hexdigest()[:16] + '"'
+        if self.path == "/trickle.png":
+            return self._trickle()
+        if self.path == "/empty.png":
+            return self._reply(200, {"Content-Type": "image/png"}, b"")
+        if self.path == "/slow.png":
+            time.sleep(REMOTE_DELAY_S * 10)
+        elif self.path.startswith(("/fresh/", "/stale/")):
+            time.sleep(REMOTE_DELAY_S)
+        else:
+            return self._reply(404, {}, b"")
+        if self.path.startswith("/stale/") and self.headers.get("If-None-Match") == etag:
+            return self._reply(304, {"ETag": etag}, b"")
+        max_age = 3600 if self.path.startswith("/fresh/") else 0
+        self._reply(200, {"Content-Type": "image/png", "ETag": etag, "Cache-Control": f"max-age={max_age}"}, self.png)
+
+    def _trickle(self) -> None:
+        self.requests.append((self.path, 200))
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(self.png)))
+        self.end_headers()
+        try:
+            for i in range(20):
+                self.wfile.write(self.png[i:i + 1])
+                self.wfile.flush()
+                time.sleep(REMOTE_DELAY_S * 2)
+        except OSError:
+            pass
+
+    def _reply(self, status: int, headers: dict, body: bytes) -> None:
+        self.requests.append((self.path, status))
+        self.send_response(status)
+        for k, v in {**headers, "Content-Length": str(len(body))}.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+def check_remote(args: argparse.Namespace) -> int:
+    n = 16
+    with tempfile.TemporaryDirectory() as td:
+        write_png(Path(td) / "x.png")
+        StubImageHost.png = (Path(td) / "x.png").read_bytes()
+        server = ThreadingHTTPServer(("127.0.0.1", 0), StubImageHost)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base = f"http://127.0.0.1:{server.server_port}"
+        urls = [f"{base}/fresh/{i}.png" for i in range(n // 2)] + [f"{base}/stale/{i}.png" for i in range(n // 2)]
+        broken = [f"{base}/{name}.png" for name in ("slow", "trickle", "empty", "missing")]
+        html = "".join(f'<img src="{u}">' for u in urls + broken)
+        remote = app.RemoteImages(app.RenderCache(Path(td) / "cache"), concurrency=8, timeout_s=REMOTE_DELAY_S * 5)
+
+        failures = 0
+
+        def expect(ok: bool, what: str) -> None:
+            nonlocal failures
+            failures += not ok
+            print(f"{'ok  ' if ok else 'FAIL'} {what}")
+
+        try:
+            t0 = time.perf_counter()
+            first = asyncio.run(remote.prefetch(app.remote_image_urls(html)))
+            wall = time.perf_counter() - t0
+            expect(all(first[u] for u in urls) and not any(first[u] for u in broken),
+                   f"first pass: {sum(first.values())}/{len(first)} usable; slow, trickling, empty and missing fail")
+            expect(wall < remote.timeout_s + REMOTE_DELAY_S * n / 8 + 0.5,
+                   f"bounded: {wall:.2f} s for {n} × {REMOTE_DELAY_S} s images with a {remote.timeout_s:g} s timeout "
+                   f"(serial ≥ {REMOTE_DELAY_S * n:.1f} s)")
+            expect(remote.failed(f"{base}/slow.png") and remote.cached(f"{base}/slow.png") is None, "timed-out URL marked failed")
+
+            StubImageHost.requests.clear()
+            asyncio.run(remote.prefetch(urls))
+            seen = [path for path, _ in StubImageHost.requests]
+            expect(not any(p.startswith("/fresh/") for p in seen), "second pass: fresh images not requested")
+            expect(sorted(s for p, s in StubImageHost.requests) == [304] * (n // 2), "second pass: stale images revalidated (304)")
+            expect(all(remote.cached(u) == (StubImageHost.png, "image/png") for u in urls), "bodies served from cache")
+            print(remote.stats())
+        finally:
+            server.shutdown()
+    return 1 if failures else 0
+
+
+def check_reruns(args: argparse.Namespace) -> int:
+    # Streamlit re-executes app.py on every rerun while the cached render queue
+    # lives on; a PDF profiled from a later execution must still get its stages.
+    full_html = app.md_to_full_html(synth_markdown(4, args.seed), "reruns")
+    seen = []
+    for run_no in (1, 2):
+        module = runpy.run_path(app.__file__, run_name="nirnay_rerun")
+        queue = module["get_render_queue"]()
+        with module["profiled"]("reruns.pdf", log_path=None) as prof:
+            job = queue.submit(full_html, chunked=True, topics_per_chunk=1, use_cache=False)
+            try:
+                job.future.result(timeout=app.PDF_JOB_TIMEOUT_S)
+                outcome = "printed"
+            except Exception as e:  # no Chromium here still records the split
+                outcome = type(e).__name__
+        stages = sorted(s["stage"] for s in prof.record()["stages"])
+        seen.append(stages)
+        print(f"run {run_no}  queue {id(queue):#x}  {outcome:<12} stages {stages}")
+    module["get_browser_pool"]().shutdown()
+    ok = bool(seen[0]) and seen[1] == seen[0]
+    print("second run profiled" if ok else "second run lost its PDF stages")
+    return 0 if ok else 1
+
+
+def compare(current: dict, baseline: dict) -> None:
+    base_rows = {r["topics"]: r for r in baseline.get("results", [])}
+    print(f"\nvs {baseline.get('revision') or '?'} (median, new/old)")
+    for row in current["results"]:
+        old = base_rows.get(row["topics"])
+        if old is None:
+            continue
+        parts = []
+        for stage_name in ("html", "pdf"):
+            if stage_name in row and stage_name in old:
+                ratio = row[stage_name]["median_ms"] / max(old[stage_name]["median_ms"], 1e-9)
+                parts.append(f"{stage_name.upper()} x{ratio:5.2f}")
+        print(f"{row['topics']:>4} topics  " + "  ".join(parts))
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    ap = argparse.ArgumentParser(description="Benchmark md_to_full_html / html_to_pdf_bytes on synthetic documents.")
+    ap.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="topic counts to generate")
+    ap.add_argument("--repeat", type=int, default=3, help="timed runs per size and stage")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--no-pdf", action="store_true", help="HTML stage only")
+    ap.add_argument("--out", help="write results JSON here (default: bench-<revision>.json)")
+    ap.add_argument("--compare", help="baseline results JSON to compare against")
+    ap.add_argument("--parity", action="store_true", help="check parser backends emit the same HTML, then exit")
+    ap.add_argument("--rank-markdown", action="store_true", help="time every installed markdown backend, then exit")
+    ap.add_argument("--check-cleanup", action="store_true", help="fuzz cleanup_markdown against the reference, then exit")
+    ap.add_argument("--check-scaling", action="store_true", help="check transform time grows linearly with topics, then exit")
+    ap.add_argument("--check-remote", action="store_true", help="exercise the remote image prefetcher on a stub host, then exit")
+    ap.add_argument("--check-reruns", action="store_true", help="profile a PDF job from a second app.py execution, then exit")
+    ap.add_argument("--corpus", nargs="*", default=[], help="extra .md files/folders for --parity / --rank-markdown / --check-cleanup")
+    return ap.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.parity:
+        sys.exit(parity(args))
+    if args.rank_markdown:
+        sys.exit(rank_markdown(args))
+    if args.check_cleanup:
+        sys.exit(check_cleanup(args))
+    if args.check_scaling:
+        sys.exit(check_scaling(args))
+    if args.check_remote:
+        sys.exit(check_remote(args))
+    if args.check_reruns:
+        sys.exit(check_reruns(args))
+    result = run(args)
+    out = Path(args.out or f"bench-{result['revision'] or 'local'}.json")
+    out.write_text(json.dumps(result, indent=1), encoding="utf-8")
+    print(f"results → {out}")
+    if args.compare:
+        compare(result, json.loads(Path(args.compare).read_text(encoding="utf-8")))
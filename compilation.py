@@ -0,0 +1,111 @@
+"""
+Weekly / monthly compilations from daily Nirnay markdown files.
+
+    python compilation.py archive/ --month 2024-05
+    python compilation.py archive/ --week 2024-W18 --pdf
+    python compilation.py archive/ --from 2024-05-01 --to 2024-05-15 --out build/ --title "Nirnay Fortnightly CA"
+
+Dailies are picked by the date in their file name (2024-05-01, 20240501 or
+01-05-2024) and merged in date order. Each daily's rendered HTML comes from
+the shared render cache, so only new or edited dailies are rendered; the
+merge itself is string work over the cached pages (see app.compile_dailies).
+Each day after the first starts on a new page; those page breaks are where
+the --pdf print is cut into pieces for the browser pool, so --no-day-breaks
+gives a continuous layout but a PDF printed in about two pieces only.
+"""
+import sys
+import time
+import argparse
+import calendar
+import subprocess
+from datetime import date, timedelta
+from pathlib import Path
+
+import app
+from batch import collect_sources
+
+
+def date_range(args: argparse.Namespace) -> tuple[date | None, date | None, str]:
+    # (start, end, label) from --month / --week / --from --to
+    if args.month:
+        year, month = map(int, args.month.split("-"))
+        start = date(year, month, 1)
+        return start, date(year, month, calendar.monthrange(year, month)[1]), start.strftime("%B %Y")
+    if args.week:
+        year, week = args.week.upper().split("-W")
+        start = date.fromisocalendar(int(year), int(week), 1)
+        return start, start + timedelta(days=6), f"Week {int(week)}, {year}"
+    start = date.fromisoformat(args.date_from) if args.date_from else None
+    end = date.fromisoformat(args.date_to) if args.date_to else None
+    label = " – ".join(d.strftime("%d %b %Y") for d in (start, end) if d is not None)
+    return start, end, label
+
+
+def run(args: argparse.Namespace) -> int:
+    try:
+        start, end, label = date_range(args)
+    except ValueError as e:
+        print(f"bad date range: {e}", file=sys.stderr)
+        return 2
+
+    dailies = app.select_dailies(collect_sources(args.inputs), start, end)
+    if not dailies:
+        print("No daily files in that range.", file=sys.stderr)
+        return 1
+
+    title = args.title or f"Nirnay Compilation {label}".strip()
+    t0 = time.perf_counter()
+    full_html, stats = app.compile_dailies(dailies, title, day_breaks=not args.no_day_breaks)
+    wall = time.perf_counter() - t0
+
+    out_dir = Path(args.out) if args.out else dailies[0][1].parent
+    out_dir.mkdir(parents=True, exist_ok=True)
+    stem = "".join(c if c.isalnum() or c in "-_" else "_" for c in title).strip("_")
+    html_path = out_dir / f"{stem}.html"
+    html_path.write_text(full_html, encoding="utf-8")
+
+    for path in stats["empty"]:
+        print(f"[skip] {path}: no topics", file=sys.stderr)
+    print(
+        f"{stats['dailies']} dailies, {stats['topics']} topics, {stats['duplicates']} duplicates dropped "
+        f"in {wall * 1000:.0f} ms → {html_path}"
+    )
+
+    if args.pdf:
+        try:
+            app.ensure_playwright_chromium()
+        except subprocess.CalledProcessError as e:
+            print(f"[pdf] could not install Chromium: {e}", file=sys.stderr)
+            return 1
+        pool = app.BrowserPool(size=args.browsers)
+        try:
+            pdf_bytes = app.html_to_pdf_bytes_chunked(full_html, pool=pool)
+        finally:
+            pool.shutdown()
+        pdf_path = html_path.with_suffix(".pdf")
+        pdf_path.write_bytes(pdf_bytes)
+        print(f"PDF → {pdf_path}")
+    return 0
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    ap = argparse.ArgumentParser(description="Merge daily Nirnay markdown files into one compilation.")
+    ap.add_argument("inputs", nargs="+", help="directories, files or glob patterns")
+    rng = ap.add_mutually_exclusive_group()
+    rng.add_argument("--month", help="YYYY-MM")
+    rng.add_argument("--week", help="ISO week, YYYY-Www")
+    ap.add_argument("--from", dest="date_from", help="first day, YYYY-MM-DD")
+    ap.add_argument("--to", dest="date_to", help="last day, YYYY-MM-DD")
+    ap.add_argument("--title", help="document title (default: from the range)")
+    ap.add_argument("--out", help="output folder (default: next to the first daily)")
+    ap.add_argument("--pdf", action="store_true", help="also print a PDF")
+    ap.add_argument(
+        "--no-day-breaks", action="store_true",
+        help="run days on without a page break (the PDF then splits only at the Index, so it barely parallelizes)",
+    )
+    ap.add_argument("--browsers", type=int, default=app.PDF_POOL_SIZE, help="concurrent Chromium instances for the PDF")
+    return ap.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(run(parse_args()))
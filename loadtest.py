@@ -0,0 +1,119 @@
+"""
+Load test for the local render service (server.py).
+
+    python server.py --no-pdf &
+    python loadtest.py                                   # /html, 8 clients, 20 s
+    python loadtest.py --endpoint pdf --concurrency 4 --duration 60
+    python loadtest.py --file archive/2024-05-01.md --same --out run.json
+
+Each client thread keeps one connection alive and sends requests back to
+back. By default every request gets a unique last line, so the service
+re-renders one topic per call (the common "small edit" case); --same sends
+identical documents and measures the cache-hit path instead. Reports
+sustained requests/s and latency percentiles over the timed window
+(a short warm-up is excluded).
+"""
+import sys
+import json
+import time
+import argparse
+import threading
+import http.client
+from pathlib import Path
+from urllib.parse import urlsplit, quote
+
+from batch import percentile
+from bench import synth_markdown
+
+
+def worker(args, md_text: str, stop_at: float, record_from: float, results: list, errors: list, lock) -> None:
+    url = urlsplit(args.url)
+    conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=args.timeout)
+    path = f"/{args.endpoint}?title={quote(args.title)}"
+    n = 0
+    while True:
+        t0 = time.perf_counter()
+        if t0 >= stop_at:
+            break
+        body = md_text if args.same else f"{md_text}\n\nRequest {threading.get_ident()}-{n}.\n"
+        n += 1
+        try:
+            conn.request("POST", path, body=body.encode("utf-8"), headers={"Content-Type": "text/markdown"})
+            resp = conn.getresponse()
+            resp.read()
+            ok = resp.status == 200
+        except (OSError, http.client.HTTPException):
+            ok = False
+            conn.close()
+            conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=args.timeout)
+        t1 = time.perf_counter()
+        if t0 < record_from:
+            continue
+        with lock:
+            (results if ok else errors).append(t1 - t0)
+    conn.close()
+
+
+def run(args: argparse.Namespace) -> dict:
+    md_text = Path(args.file).read_text(encoding="utf-8") if args.file else synth_markdown(args.topics, args.seed)
+
+    start = time.perf_counter()
+    record_from = start + args.warmup
+    stop_at = record_from + args.duration
+    results: list[float] = []
+    errors: list[float] = []
+    lock = threading.Lock()
+    threads = [
+        threading.Thread(target=worker, args=(args, md_text, stop_at, record_from, results, errors, lock), daemon=True)
+        for _ in range(args.concurrency)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    ms = [r * 1000 for r in results]
+    report = {
+        "endpoint": args.endpoint,
+        "concurrency": args.concurrency,
+        "duration_s": args.duration,
+        "unique_docs": not args.same,
+        "requests": len(results),
+        "errors": len(errors),
+        "rps": round(len(results) / args.duration, 2),
+        "p50_ms": round(percentile(ms, 50), 1),
+        "p95_ms": round(percentile(ms, 95), 1),
+        "p99_ms": round(percentile(ms, 99), 1),
+        "max_ms": round(max(ms, default=0.0), 1),
+    }
+    return report
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    ap = argparse.ArgumentParser(description="Measure sustained throughput and tail latency of server.py.")
+    ap.add_argument("--url", default="http://127.0.0.1:8765")
+    ap.add_argument("--endpoint", choices=("html", "pdf"), default="html")
+    ap.add_argument("--concurrency", type=int, default=8, help="client threads (one connection each)")
+    ap.add_argument("--duration", type=float, default=20.0, help="timed seconds")
+    ap.add_argument("--warmup", type=float, default=2.0, help="untimed seconds before measuring")
+    ap.add_argument("--timeout", type=float, default=300.0, help="per-request socket timeout")
+    ap.add_argument("--file", help="markdown document to send (default: synthetic)")
+    ap.add_argument("--topics", type=int, default=10, help="synthetic document size")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--title", default="loadtest")
+    ap.add_argument("--same", action="store_true", help="send identical documents (cache hits)")
+    ap.add_argument("--out", help="also write the report JSON here")
+    return ap.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = run(args)
+    print(
+        f"{report['requests']} requests, {report['errors']} errors in {args.duration:.0f} s  "
+        f"{report['rps']:.2f} req/s  p50 {report['p50_ms']:.1f} ms  p95 {report['p95_ms']:.1f} ms  "
+        f"p99 {report['p99_ms']:.1f} ms  max {report['max_ms']:.1f} ms"
+    )
+    if args.out:
+        Path(args.out).write_text(json.dumps(report, indent=1), encoding="utf-8")
+    sys.exit(1 if report["errors"] else 0)
@@ -0,0 +1,328 @@
+"""
+Local HTTP render service: the Nirnay pipeline as an API.
+
+    python server.py                         # http://127.0.0.1:8765
+    python server.py --port 9000 --jobs 4 --browsers 3
+    python server.py --no-pdf                # HTML only, no Chromium
+
+    curl --data-binary @day.md "http://127.0.0.1:8765/html?title=day" > day.html
+    curl --data-binary @day.md "http://127.0.0.1:8765/pdf?title=day" > day.pdf
+    curl -d '{"items": [{"id": "a", "markdown": "# A", "format": "pdf"}]}' http://127.0.0.1:8765/batch
+
+Endpoints
+    POST /html    markdown body (or JSON {"markdown", "title"}) → text/html
+    POST /pdf     same input, or JSON {"html"} to print ready HTML → application/pdf
+    POST /batch   JSON {"items": [{"id", "markdown" | "html", "title", "format"}]}
+                  → NDJSON, one line per item in completion order (PDFs base64)
+    GET  /health  pool / cache counters
+
+Plain asyncio, no web framework. HTML renders run on a process pool, PDFs
+on one long-lived warm browser pool; both go through the shared render
+cache. Responses are streamed with chunked transfer encoding and
+connections are kept alive. Binds to localhost by default: there is no
+authentication.
+"""
+import sys
+import json
+import time
+import base64
+import asyncio
+import argparse
+import subprocess
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ProcessPoolExecutor
+
+import app
+
+MAX_BODY_MB = 64
+STREAM_CHUNK = 64 * 1024
+REASONS = {
+    200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+    411: "Length Required", 413: "Payload Too Large", 500: "Internal Server Error",
+    503: "Service Unavailable", 504: "Gateway Timeout",
+}
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+# ============================================================
+# Render workers
+# ============================================================
+def render_html_job(md_text: str, title: str) -> str:
+    # Runs in a worker process; each worker has its own cache handle on the
+    # shared disk tier.
+    return app.cached_md_to_full_html(md_text, title_fallback=title)
+
+
+class RenderService:
+    def __init__(self, jobs: int | None, browsers: int, pdf: bool, pdf_timeout: float):
+        self.html_pool = ProcessPoolExecutor(max_workers=jobs)
+        # Fork the HTML workers now, before any browser threads exist.
+        self.html_pool.submit(int).result()
+        self.browser_pool = app.BrowserPool(size=browsers) if pdf else None
+        self.cache = app.get_render_cache()
+        self.remote = app.get_remote_images()
+        self.pdf_timeout = pdf_timeout
+        self.served = 0
+
+    async def html(self, md_text: str, title: str) -> str:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.html_pool, render_html_job, md_text, title)
+
+    async def pdf(self, full_html: str) -> bytes:
+        if self.browser_pool is None:
+            raise HttpError(503, "PDF rendering is disabled (--no-pdf)")
+        key = app.pdf_cache_key(full_html)
+        hit = self.cache.get(key)
+        if hit is not None:
+            return hit
+
+        if app.REMOTE_IMAGES:
+            # Remote images land in the cache before Chromium asks for them.
+            await self.remote.prefetch(app.remote_image_urls(full_html))
+        fut = self.browser_pool.submit(app.print_pdf, full_html)
+        try:
+            pdf_bytes = await asyncio.wait_for(asyncio.wrap_future(fut), self.pdf_timeout)
+        except asyncio.TimeoutError:
+            self.browser_pool.abandon(fut)
+            raise HttpError(504, f"PDF render exceeded {self.pdf_timeout:.0f} s")
+        self.cache.put(key, pdf_bytes)
+        return pdf_bytes
+
+    async def render(self, item: dict, fmt: str) -> bytes:
+        # item: {"markdown", "title"} or, for PDF, {"html"}
+        if fmt == "pdf" and isinstance(item.get("html"), str):
+            return await self.pdf(item["html"])
+        md_text = item.get("markdown")
+        if not isinstance(md_text, str):
+            raise HttpError(400, 'expected a "markdown" string')
+        full_html = await self.html(md_text, str(item.get("title") or "document"))
+        if fmt == "pdf":
+            return await self.pdf(full_html)
+        return full_html.encode("utf-8")
+
+    def stats(self) -> dict:
+        return {
+            "served": self.served,
+            "pdf_pool": self.browser_pool.stats() if self.browser_pool is not None else None,
+            "cache": {"hits": self.cache.hits, "misses": self.cache.misses},
+            "remote_images": self.remote.stats(),
+        }
+
+    def shutdown(self) -> None:
+        self.html_pool.shutdown(cancel_futures=True)
+        if self.browser_pool is not None:
+            self.browser_pool.shutdown()
+
+
+# ============================================================
+# HTTP/1.1 plumbing
+# ============================================================
+async def read_request(reader: asyncio.StreamReader) -> tuple[str, str, dict, bytes] | None:
+    line = await reader.readline()
+    if not line.strip():
+        return None
+    try:
+        method, target, _version = line.decode("latin-1").split()
+    except ValueError:
+        raise HttpError(400, "malformed request line")
+
+    headers = {}
+    while True:
+        raw = await reader.readline()
+        if raw in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = raw.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        raise HttpError(411, "send a Content-Length")
+    try:
+        length = int(headers.get("content-length") or 0)
+    except ValueError:
+        raise HttpError(400, "malformed Content-Length")
+    if length < 0:
+        raise HttpError(400, "malformed Content-Length")
+    if length > MAX_BODY_MB * 1024 * 1024:
+        raise HttpError(413, f"body larger than {MAX_BODY_MB} MB")
+    body = await reader.readexactly(length) if length else b""
+    return method.upper(), target, headers, body
+
+
+async def send_head(writer: asyncio.StreamWriter, status: int, content_type: str, keep_alive: bool) -> None:
+    writer.write(
+        (
+            f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            "Transfer-Encoding: chunked\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        ).encode("latin-1")
+    )
+
+
+async def send_chunk(writer: asyncio.StreamWriter, data: bytes) -> None:
+    # Zero-copy slices; drain() applies back-pressure from slow clients.
+    view = memoryview(data)
+    for i in range(0, len(view), STREAM_CHUNK):
+        piece = view[i: i + STREAM_CHUNK]
+        writer.write(f"{len(piece):x}\r\n".encode("latin-1"))
+        writer.write(piece)
+        writer.write(b"\r\n")
+        await writer.drain()
+
+
+async def send_end(writer: asyncio.StreamWriter) -> None:
+    writer.write(b"0\r\n\r\n")
+    await writer.drain()
+
+
+async def send_body(writer, status: int, content_type: str, data: bytes, keep_alive: bool) -> None:
+    await send_head(writer, status, content_type, keep_alive)
+    await send_chunk(writer, data)
+    await send_end(writer)
+
+
+def send_json(writer, status: int, payload: dict, keep_alive: bool):
+    return send_body(writer, status, "application/json", json.dumps(payload).encode("utf-8"), keep_alive)
+
+
+# ============================================================
+# Routes
+# ============================================================
+def parse_input(target: str, headers: dict, body: bytes) -> dict:
+    query = parse_qs(urlsplit(target).query)
+    title = (query.get("title") or ["document"])[0]
+    if headers.get("content-type", "").startswith("application/json"):
+        try:
+            item = json.loads(body)
+        except ValueError:
+            raise HttpError(400, "invalid JSON")
+        if not isinstance(item, dict):
+            raise HttpError(400, "expected a JSON object")
+        item.setdefault("title", title)
+        return item
+    return {"markdown": body.decode("utf-8", errors="ignore"), "title": title}
+
+
+async def handle_batch(service: RenderService, writer, body: bytes, keep_alive: bool) -> None:
+    try:
+        items = json.loads(body)["items"]
+    except (ValueError, KeyError, TypeError):
+        raise HttpError(400, 'expected JSON {"items": [...]}')
+    if not isinstance(items, list):
+        raise HttpError(400, 'expected JSON {"items": [...]}')
+
+    async def one(i: int, item) -> dict:
+        item = item if isinstance(item, dict) else {}
+        fmt = item.get("format", "html")
+        out = {"id": item.get("id", i), "format": fmt}
+        t0 = time.perf_counter()
+        try:
+            if fmt not in ("html", "pdf"):
+                raise HttpError(400, f"unknown format {fmt!r}")
+            data = await service.render(item, fmt)
+            out["body"] = base64.b64encode(data).decode("ascii") if fmt == "pdf" else data.decode("utf-8")
+            out["ok"] = True
+        except Exception as e:
+            out.update(ok=False, error=str(e))
+        out["ms"] = round((time.perf_counter() - t0) * 1000, 1)
+        return out
+
+    await send_head(writer, 200, "application/x-ndjson", keep_alive)
+    for done in asyncio.as_completed([one(i, item) for i, item in enumerate(items)]):
+        await send_chunk(writer, json.dumps(await done).encode("utf-8") + b"\n")
+    await send_end(writer)
+
+
+async def dispatch(service: RenderService, writer, method: str, target: str, headers: dict, body: bytes, keep_alive: bool):
+    path = urlsplit(target).path.rstrip("/") or "/"
+    if path == "/health":
+        if method != "GET":
+            raise HttpError(405, "use GET")
+        return await send_json(writer, 200, service.stats(), keep_alive)
+    if path not in ("/html", "/pdf", "/batch"):
+        raise HttpError(404, f"no route {path}")
+    if method != "POST":
+        raise HttpError(405, "use POST")
+
+    if path == "/batch":
+        return await handle_batch(service, writer, body, keep_alive)
+
+    fmt = path[1:]
+    data = await service.render(parse_input(target, headers, body), fmt)
+    content_type = "application/pdf" if fmt == "pdf" else "text/html; charset=utf-8"
+    await send_body(writer, 200, content_type, data, keep_alive)
+
+
+def make_handler(service: RenderService):
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except HttpError as e:
+                    await send_json(writer, e.status, {"error": str(e)}, keep_alive=False)
+                    break
+                if request is None:
+                    break
+                method, target, headers, body = request
+                keep_alive = headers.get("connection", "").lower() != "close"
+                try:
+                    await dispatch(service, writer, method, target, headers, body, keep_alive)
+                    service.served += 1
+                except HttpError as e:
+                    await send_json(writer, e.status, {"error": str(e)}, keep_alive)
+                except Exception as e:
+                    await send_json(writer, 500, {"error": f"{type(e).__name__}: {e}"}, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    return handle
+
+
+# ============================================================
+# Main
+# ============================================================
+async def serve(args: argparse.Namespace) -> None:
+    pdf = not args.no_pdf
+    if pdf:
+        try:
+            app.ensure_playwright_chromium()
+        except subprocess.CalledProcessError as e:
+            print(f"[pdf] could not install Chromium, serving HTML only: {e}", file=sys.stderr)
+            pdf = False
+
+    service = RenderService(args.jobs, args.browsers, pdf, args.pdf_timeout)
+    server = await asyncio.start_server(make_handler(service), args.host, args.port)
+    print(f"Nirnay render service on http://{args.host}:{args.port} (pdf {'on' if pdf else 'off'})")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.shutdown()
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    ap = argparse.ArgumentParser(description="Serve the Nirnay markdown → HTML/PDF pipeline over HTTP.")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--jobs", type=int, default=None, help="HTML worker processes (default: CPU count)")
+    ap.add_argument("--browsers", type=int, default=app.PDF_POOL_SIZE, help="concurrent Chromium instances")
+    ap.add_argument("--pdf-timeout", type=float, default=app.PDF_JOB_TIMEOUT_S, help="seconds per PDF")
+    ap.add_argument("--no-pdf", action="store_true", help="HTML only")
+    return ap.parse_args(argv)
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(serve(parse_args()))
+    except KeyboardInterrupt:
+        pass